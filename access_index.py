@@ -0,0 +1,48 @@
+import logging
+
+
+class AccessIndex:
+    """Индекс доступа: множество допустимых пользователей с объединенными администраторами.
+
+    Проверка доступа - поиск в множестве без блокировок. При изменении множество не правится
+    на месте, а заменяется новым, поэтому читатели всегда видят согласованное состояние.
+    """
+
+    def __init__(self, admin_ids=(), user_ids=()):
+        self.admins = frozenset(admin_ids)
+        self.users = frozenset(user_ids)
+        self.allowed = self.admins | self.users
+        self.refreshes = 0
+
+    def is_allowed(self, user_id) -> bool:
+        return user_id in self.allowed
+
+    def is_admin(self, user_id) -> bool:
+        return user_id in self.admins
+
+    def is_user(self, user_id) -> bool:
+        return user_id in self.users
+
+    def set_admins(self, admin_ids):
+        self.admins = frozenset(admin_ids)
+        self.allowed = self.admins | self.users
+
+    def set_users(self, user_ids):
+        self.users = frozenset(user_ids)
+        self.allowed = self.admins | self.users
+        self.refreshes += 1
+        logging.info(f"Access index loaded: {len(self.users)} users, {len(self.admins)} admins")
+
+    def add(self, user_id):
+        self.users = self.users | {user_id}
+        self.allowed = self.allowed | {user_id}
+
+    def remove(self, user_id):
+        self.users = self.users - {user_id}
+        self.allowed = self.admins | self.users
+
+    def get_users(self) -> list:
+        return sorted(self.users)
+
+    def get_stats(self) -> dict:
+        return {"users": len(self.users), "admins": len(self.admins), "refreshes": self.refreshes}
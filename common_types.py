@@ -1,47 +1,32 @@
+import time
 
-import asyncio
 
-
-class SafeDict:
+class StageTimer:
+    """Замеряет длительность последовательных этапов обработки."""
     def __init__(self):
-        self.lock = asyncio.Lock()
-        self.data = {}
-
-    async def set(self, key, value):
-        async with self.lock:
-            self.data[key] = value
-
-    async def get(self, key, default_value):
-        async with self.lock:
-            return self.data.get(key, default_value)
-    
-    async def delete(self, key):
-        async with self.lock:
-            if key in self.data:
-                del self.data[key]
-
-class SafeList:
-    def __init__(self, l: list):
-        self.lock = asyncio.Lock()
-        self.data = l
-
-    async def append(self, value):
-        async with self.lock:
-            self.data.append(value)
-
-    async def get(self, index):
-        async with self.lock:
-            return self.data[index]
-        
-    async def remove(self, value):
-        async with self.lock:
-            if value in self.data:
-                self.data.remove(value)
-    
-    async def get_all(self):
-        async with self.lock:
-            return list(self.data)
-        
+        self.timings = {}
+        self.start = time.monotonic()
+        self.last = self.start
+
+    def mark(self, stage):
+        now = time.monotonic()
+        self.timings[stage] = now - self.last
+        self.last = now
+
+    async def measure(self, stage, awaitable):
+        """Замеряет этап, выполняемый параллельно с другими."""
+        start = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self.timings[stage] = time.monotonic() - start
+
+    def total(self) -> float:
+        return time.monotonic() - self.start
+
+    def __str__(self):
+        return ", ".join(f"{stage} {seconds:.2f} сек." for stage, seconds in self.timings.items())
+
 
 def dict_to_markdown(d, indent=0):
     result = []
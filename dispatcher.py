@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+# Политики переполнения очереди
+OVERFLOW_REJECT = "reject"            # отказать в приеме, Telegram повторит доставку позже
+OVERFLOW_DROP_OLDEST = "drop_oldest"  # выбросить самое старое обновление из очереди чата
+OVERFLOW_DROP_NEWEST = "drop_newest"  # выбросить пришедшее обновление
+
+overflow_policies = (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)
+
+# Сколько последних времен ожидания хранить для расчета перцентилей
+WAIT_SAMPLES_SIZE = 1000
+
+
+def get_update_key(update):
+    """Ключ очереди: обновления с одинаковым ключом обрабатываются строго по порядку."""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    # Обновления без чата и пользователя упорядочивать не нужно
+    return ("update", update.update_id)
+
+
+class UpdateDispatcher:
+    """Ограниченная очередь обновлений между вебхуком и process_update.
+
+    Для каждого чата ведется своя FIFO-очередь, обрабатываемая одной задачей,
+    поэтому сообщения одного пользователя не гоняются за его историей.
+    Общее количество одновременно обрабатываемых обновлений ограничено семафором.
+    """
+
+    def __init__(self, process_update, max_concurrency=8, max_queue_per_chat=20, max_queue_total=500,
+                 overflow_policy=OVERFLOW_REJECT, on_drop=None):
+        if overflow_policy not in overflow_policies:
+            raise ValueError(f"Неизвестная политика переполнения очереди: {overflow_policy}")
+        self.process_update = process_update
+        self.max_concurrency = max_concurrency
+        self.max_queue_per_chat = max_queue_per_chat
+        self.max_queue_total = max_queue_total
+        self.overflow_policy = overflow_policy
+        # Вызывается для каждого выброшенного из очереди обновления
+        self.on_drop = on_drop
+
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.queues = {}   # ключ чата -> deque[(время постановки, update)]
+        self.workers = {}  # ключ чата -> задача, разбирающая очередь
+        self.queued = 0
+        self.active = 0
+
+        # Статистика
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.max_queued = 0
+        self.max_wait = 0.0
+        self.wait_samples = deque(maxlen=WAIT_SAMPLES_SIZE)
+
+    def submit(self, update) -> bool:
+        """Ставит обновление в очередь. Возвращает False, если обновление не принято."""
+        key = get_update_key(update)
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = deque()
+            self.queues[key] = queue
+
+        if len(queue) >= self.max_queue_per_chat or self.queued >= self.max_queue_total:
+            if self.overflow_policy == OVERFLOW_REJECT:
+                self.rejected += 1
+                if not queue:
+                    del self.queues[key]
+                logging.warning(f"Очередь обновлений переполнена, обновление {update.update_id} отклонено")
+                return False
+            if self.overflow_policy == OVERFLOW_DROP_OLDEST and queue:
+                _, oldest = queue.popleft()
+                self.queued -= 1
+                self._drop(oldest)
+            else:
+                if not queue:
+                    del self.queues[key]
+                self._drop(update)
+                return True
+
+        queue.append((time.monotonic(), update))
+        self.queued += 1
+        self.submitted += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        if key not in self.workers:
+            self.workers[key] = asyncio.create_task(self._drain(key, queue))
+        return True
+
+    def _drop(self, update):
+        self.dropped += 1
+        logging.warning(f"Очередь обновлений переполнена, обновление {update.update_id} выброшено")
+        if self.on_drop is not None:
+            try:
+                self.on_drop(update)
+            except Exception as e:
+                logging.error(f"Ошибка в обработчике выброшенного обновления: {e}")
+
+    async def _drain(self, key, queue):
+        try:
+            while queue:
+                async with self.semaphore:
+                    if not queue:
+                        break
+                    enqueued_at, update = queue.popleft()
+                    self.queued -= 1
+                    wait = time.monotonic() - enqueued_at
+                    self.wait_samples.append(wait)
+                    self.max_wait = max(self.max_wait, wait)
+                    self.active += 1
+                    try:
+                        await self.process_update(update)
+                    except Exception as e:
+                        self.failed += 1
+                        logging.error(f"Ошибка при обработке обновления {update.update_id}: {e}", exc_info=True)
+                    finally:
+                        self.active -= 1
+                        self.processed += 1
+        finally:
+            self.workers.pop(key, None)
+            if not queue and self.queues.get(key) is queue:
+                del self.queues[key]
+
+    def get_stats(self) -> dict:
+        samples = sorted(self.wait_samples)
+        if samples:
+            avg_wait = sum(samples) / len(samples)
+            p95_wait = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        else:
+            avg_wait = p95_wait = 0.0
+        return {
+            "queued": self.queued,
+            "active": self.active,
+            "chats": len(self.queues),
+            "max_queued": self.max_queued,
+            "max_concurrency": self.max_concurrency,
+            "max_queue_per_chat": self.max_queue_per_chat,
+            "max_queue_total": self.max_queue_total,
+            "overflow_policy": self.overflow_policy,
+            "submitted": self.submitted,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "avg_wait_sec": round(avg_wait, 4),
+            "p95_wait_sec": round(p95_wait, 4),
+            "max_wait_sec": round(self.max_wait, 4),
+        }
+
+    async def shutdown(self, timeout=10.0):
+        """Дожидается разбора очередей, по истечении таймаута отменяет оставшиеся задачи."""
+        workers = list(self.workers.values())
+        if not workers:
+            return
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.warning(f"Диспетчер остановлен, не обработано обновлений: {self.queued}")
+
+
+def create_dispatcher_from_os(process_update, on_drop=None) -> UpdateDispatcher:
+    dispatcher = UpdateDispatcher(
+        process_update,
+        max_concurrency=int(os.getenv('DISPATCHER_MAX_CONCURRENCY', '8')),
+        max_queue_per_chat=int(os.getenv('DISPATCHER_MAX_QUEUE_PER_CHAT', '20')),
+        max_queue_total=int(os.getenv('DISPATCHER_MAX_QUEUE_TOTAL', '500')),
+        overflow_policy=os.getenv('DISPATCHER_OVERFLOW_POLICY', OVERFLOW_REJECT),
+        on_drop=on_drop,
+    )
+    logging.info(f"Dispatcher settings: concurrency {dispatcher.max_concurrency}, "
+                 f"queue per chat {dispatcher.max_queue_per_chat}, total queue {dispatcher.max_queue_total}, "
+                 f"overflow policy {dispatcher.overflow_policy}")
+    return dispatcher
@@ -1,10 +1,12 @@
+import asyncio
 from datetime import datetime, timezone
 import logging
 import os
 import re
-from elasticsearch import Elasticsearch
+import time
 
 from common_types import dict_to_markdown
+from embeddings import embedding_dimensions, get_embeddings, get_note_embedding_text, is_semantic_search_enabled, is_zero_vector
 
 # Получите URL кластера из переменной окружения
 bonsai_url = os.getenv('BONSAI_URL')
@@ -14,20 +16,73 @@ access_secret_key = os.getenv('ELASTIC_SECRET_KEY')
 
 notes_index_name="user_notes_index"
 
-if not bonsai_url:
-    raise ValueError("Переменная окружения BONSAI_URL не установлена")
+# Параметры пула соединений и таймауты запросов
+elastic_pool_size = int(os.getenv('ELASTIC_POOL_SIZE', '10'))
+elastic_timeout = float(os.getenv('ELASTIC_TIMEOUT', '10'))
+elastic_search_timeout = float(os.getenv('ELASTIC_SEARCH_TIMEOUT', '5'))
+elastic_retry_on_conflict = int(os.getenv('ELASTIC_RETRY_ON_CONFLICT', '3'))
 
-es = Elasticsearch(
-    [bonsai_url],
-    http_auth=(access_key, access_secret_key)
-)
+# Асинхронный клиент создается при первом обращении
+es = None
 
 def get_connection():
+    global es
+    if es is None:
+        if not bonsai_url:
+            raise ValueError("Переменная окружения BONSAI_URL не установлена")
+        from elasticsearch import AsyncElasticsearch
+        es = AsyncElasticsearch(
+            [bonsai_url],
+            http_auth=(access_key, access_secret_key),
+            maxsize=elastic_pool_size,
+            timeout=elastic_timeout,
+            max_retries=2,
+            retry_on_timeout=True,
+        )
     return es
 
-def create_indexes():
-    # Настройки и маппинг 
-    index_settings = {
+async def init_elastic():
+    """Создает клиент, проверяет доступность кластера и определяет схему индекса. Вызывается при старте бота."""
+    if not await get_connection().ping(request_timeout=elastic_search_timeout):
+        logging.error("Elasticsearch недоступен при старте, заметки могут не работать")
+        return
+    try:
+        await load_notes_schema_version()
+        await put_added_fields(notes_index_name)
+    except Exception as e:
+        logging.error(f"Не удалось определить схему индекса заметок: {e}")
+
+async def close_elastic():
+    global es
+    if es is not None:
+        await es.close()
+        es = None
+
+# Версия схемы индекса заметок (_meta.schema_version):
+# 1 - исходная схема, UserId типа text;
+# 2 - UserId типа keyword, документы маршрутизируются по пользователю;
+# 3 - добавлен вектор заметки Embedding для семантического поиска.
+latest_schema_version = 3
+# Версия схемы индекса, на который указывает псевдоним notes_index_name. Определяется при старте
+# и перечитывается раз в notes_schema_refresh_interval секунд, чтобы подхватить переключение псевдонима
+notes_schema_version = 1
+notes_schema_loaded_at = 0.0
+notes_schema_refresh_interval = float(os.getenv('ELASTIC_SCHEMA_REFRESH_INTERVAL', '60'))
+
+# Поля, добавленные в маппинг без смены версии схемы. В существующие индексы добавляются при старте бота
+notes_added_fields = {
+    # Копия _id: сортировка по _id требует fielddata, а по keyword-полю - нет
+    "NoteId": {"type": "keyword"},
+    # Время последней записи заметки, по нему миграция дописывает изменения в новый индекс
+    "UpdatedAt": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
+}
+
+def get_versioned_index_name(version:int) -> str:
+    return f"{notes_index_name}_v{version}"
+
+def get_notes_index_body(version:int) -> dict:
+    """Настройки и маппинг индекса заметок заданной версии схемы."""
+    return {
     "settings": {
         "analysis": {
             "analyzer": {
@@ -54,8 +109,11 @@ def create_indexes():
         }
     },
     "mappings": {
+        "_meta": {"schema_version": version},
+        # Запись без маршрутизации в такой индекс - ошибка, а не документ на чужом шарде
+        **({"_routing": {"required": True}} if version >= 2 else {}),
         "properties": {
-            "UserId": {"type": "text"},
+            "UserId": {"type": "keyword" if version >= 2 else "text"},
             "Title": {
                 "type": "text",
                 "analyzer": "russian_analyzer"
@@ -68,22 +126,79 @@ def create_indexes():
             "CreatedDate": {
                 "type":   "date",
                 "format": "strict_date_optional_time||epoch_millis"
-                }
+                },
+            **notes_added_fields,
+            **({"Embedding": {"type": "dense_vector", "dims": embedding_dimensions}} if version >= 3 else {}),
             }
         }
     }
-    response = {}
-    
-    if not es.indices.exists(index=notes_index_name):
-        response = es.indices.create(index=notes_index_name, body=index_settings, ignore=400)   
-    else: 
-        print(f'Индекс {notes_index_name} уже существует.')
+
+async def create_indexes():
+    """Создает индекс заметок последней версии схемы и псевдоним notes_index_name на него.
+
+    Существующий индекс переводится на новую схему через notes_migration.py.
+    """
+    if await get_connection().indices.exists(index=notes_index_name):
+        print(f'Индекс {notes_index_name} уже существует. Для перехода на новую схему используйте notes_migration.py.')
         return
+    index_name = get_versioned_index_name(latest_schema_version)
+    index_body = get_notes_index_body(latest_schema_version)
+    index_body["aliases"] = {notes_index_name: {}}
+    response = await get_connection().indices.create(index=index_name, body=index_body, ignore=400)
      #Проверка результата
     if 'acknowledged' in response:
-        print(f"Индекс {notes_index_name} успешно создан.")
+        print(f"Индекс {index_name} с псевдонимом {notes_index_name} успешно создан.")
     else:
-        print(f"Ошибка при создании индекса {notes_index_name}: {response}")
+        print(f"Ошибка при создании индекса {index_name}: {response}")
+
+async def get_index_schema_version(index:str) -> int:
+    """Версия схемы индекса из _meta. Индексы без _meta созданы по исходной схеме."""
+    response = await get_connection().indices.get_mapping(index=index)
+    versions = [mapping["mappings"].get("_meta", {}).get("schema_version", 1) for mapping in response.values()]
+    return min(versions) if versions else 1
+
+async def put_added_fields(index:str):
+    """Добавляет в маппинг индекса поля notes_added_fields, чтобы они не были созданы динамическим маппингом."""
+    await get_connection().indices.put_mapping(index=index, body={"properties": notes_added_fields})
+
+async def load_notes_schema_version():
+    global notes_schema_version, notes_schema_loaded_at
+    notes_schema_loaded_at = time.monotonic()
+    version = await get_index_schema_version(notes_index_name)
+    if version != notes_schema_version:
+        logging.info(f"Notes index schema version: {version}")
+    notes_schema_version = version
+
+async def get_routing(user_id):
+    """Маршрутизация документов по пользователю, если ее поддерживает схема индекса."""
+    if time.monotonic() - notes_schema_loaded_at > notes_schema_refresh_interval:
+        try:
+            await load_notes_schema_version()
+        except Exception as e:
+            logging.error(f"Не удалось определить схему индекса заметок: {e}")
+    return str(user_id) if notes_schema_version >= 2 else None
+
+class RoutingMissingError(Exception):
+    """Индекс требует маршрутизацию документов, а операция выполнена без нее."""
+
+def is_routing_missing(error) -> bool:
+    return isinstance(error, RoutingMissingError) or getattr(error, "error", None) == "routing_missing_exception"
+
+async def with_user_routing(user_id, operation):
+    """Выполняет operation(routing) с маршрутизацией по пользователю.
+
+    Версия схемы кэшируется, поэтому сразу после переключения псевдонима на индекс с обязательной
+    маршрутизацией запись может уйти без нее. Тогда схема перечитывается, и операция повторяется один раз.
+    """
+    routing = await get_routing(user_id)
+    try:
+        return await operation(routing)
+    except Exception as e:
+        if routing is not None or not is_routing_missing(e):
+            raise
+        logging.info("Индекс заметок требует маршрутизацию, версия схемы перечитывается")
+    await load_notes_schema_version()
+    return await operation(await get_routing(user_id))
 
 def get_elastic_datetime_now_utc():
     # Получаем текущее время в UTC
@@ -92,7 +207,7 @@ def get_elastic_datetime_now_utc():
     iso_date_utc = now_utc.replace(microsecond=0).isoformat()
     return iso_date_utc
 
-def add_note(user_id:int, title:str, body:str, tags:list[str]):
+async def add_note(user_id:int, title:str, body:str, tags:list[str]):
     note_document = {
         "UserId": user_id,
         "Title": title,
@@ -102,40 +217,107 @@ def add_note(user_id:int, title:str, body:str, tags:list[str]):
      # Получаем текущее время в UTC
     now_utc = datetime.now(timezone.utc)
     total_seconds = int(now_utc.timestamp())
-    add_or_update_document_common(index_name=notes_index_name, document=note_document, document_id=total_seconds)
+    await attach_embeddings([note_document])
+    await with_user_routing(user_id, lambda routing: add_or_update_document_common(
+        index_name=notes_index_name, document=note_document, document_id=total_seconds, routing=routing))
 
-def update_note(doc_id:int, user_id:int, title:str, body:str, tags:list[str]):
+async def update_note(doc_id:int, user_id:int, title:str, body:str, tags:list[str]):
     note_document = {
         "UserId": user_id,
         "Title": title,
         "Body": str(body),
         "Tags": tags
         }
-    add_or_update_document_common(index_name=notes_index_name, document=note_document, document_id=doc_id)
+    await attach_embeddings([note_document])
+    await with_user_routing(user_id, lambda routing: add_or_update_document_common(
+        index_name=notes_index_name, document=note_document, document_id=doc_id, routing=routing))
 
 
-def add_or_update_document_common(index_name, document, document_id, need_to_update_documents=True):
+def is_hybrid_search_available() -> bool:
+    return notes_schema_version >= 3 and is_semantic_search_enabled()
 
+async def attach_embeddings(documents:list[dict]):
+    """Добавляет в документы векторы заметок, если их поддерживает схема индекса.
+
+    Заметка без вектора находится только полнотекстовым поиском, поэтому ошибка не прерывает запись.
+    """
+    if not documents or not is_hybrid_search_available():
+        return
     try:
-        document['CreatedDate']=get_elastic_datetime_now_utc()
-        update_body = {
-            "doc": document,
-            "doc_as_upsert": True
-        }
-        if need_to_update_documents:
-            response = es.update(index=index_name, id=document_id, body=update_body)
-            # print(f"Document {document_id} updated or created")
-        else:
-            if not es.exists(index=index_name, id=document_id):
-                response = es.index(index=index_name, id=document_id, body=document)
-            else:
-                skipped_docs += 1
-                # print(f"Document {document_id} exists and not updated")
+        vectors = await get_embeddings([get_note_embedding_text(document["Title"], document["Body"], document.get("Tags"))
+                                        for document in documents])
+        for document, vector in zip(documents, vectors):
+            if not is_zero_vector(vector):
+                document["Embedding"] = vector
     except Exception as e:
-         logging.error(f"Error in add_or_update_document: {e}")
+        logging.error(f"Не удалось получить векторы заметок: {e}")
 
-def get_notes_by_query(user_id: int, search_text: str = None, start_date: str = None, end_date: str = None, top_k=10):
+async def add_or_update_document_common(index_name, document, document_id, need_to_update_documents=True, routing=None):
+    """Создает или обновляет документ. Ошибки записи передаются вызывающему коду."""
+    document['NoteId']=str(document_id)
+    document['CreatedDate']=get_elastic_datetime_now_utc()
+    document['UpdatedAt']=document['CreatedDate']
+    update_body = {
+        "doc": document,
+        "doc_as_upsert": True
+    }
+    if need_to_update_documents:
+        response = await get_connection().update(index=index_name, id=document_id, body=update_body, routing=routing,
+                                                 retry_on_conflict=elastic_retry_on_conflict)
+        # print(f"Document {document_id} updated or created")
+    else:
+        if not await get_connection().exists(index=index_name, id=document_id, routing=routing):
+            response = await get_connection().index(index=index_name, id=document_id, body=document, routing=routing)
+        else:
+            logging.info(f"Document {document_id} exists and not updated")
+
+# Поля, которые не нужно возвращать из поиска
+notes_source_excludes = ["Embedding"]
+# Параметр k метода Reciprocal Rank Fusion: чем больше, тем меньше вес первых позиций
+notes_rrf_k = int(os.getenv('NOTES_RRF_K', '60'))
+# Минимальное косинусное сходство заметки с запросом: менее похожие заметки не попадают в выдачу поиска по векторам
+notes_vector_min_similarity = float(os.getenv('NOTES_VECTOR_MIN_SIMILARITY', '0.3'))
+
+def build_notes_filters(user_id: int, start_date: str = None, end_date: str = None) -> list[dict]:
+    filters = [{"term": {"UserId": str(user_id)}}]
+    # Диапазонный фильтр по дате
+    if start_date or end_date:
+        date_range = {}
+        if start_date:
+            date_range["gte"] = start_date
+        if end_date:
+            date_range["lte"] = end_date
+        filters.append({"range": {"CreatedDate": date_range}})
+    return filters
+
+async def search_notes(user_id: int, query: dict, size: int):
+    search_query = {"query": query, "size": size, "_source": {"excludes": notes_source_excludes}}
+    response = await get_connection().search(index=notes_index_name, body=search_query, routing=await get_routing(user_id),
+                                             request_timeout=elastic_search_timeout)
+    return rebuild_response(response)
+
+def fuse_rankings(rankings: list[list[dict]], top_k: int) -> list[dict]:
+    """Объединяет ранжирования методом Reciprocal Rank Fusion: score = сумма 1 / (k + позиция)."""
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            note_id = document['NoteId']
+            scores[note_id] = scores.get(note_id, 0.0) + 1.0 / (notes_rrf_k + rank)
+            documents.setdefault(note_id, document)
+    fused = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    for note_id in fused:
+        documents[note_id]['Score'] = scores[note_id]
+    return [documents[note_id] for note_id in fused]
+
+async def get_notes_by_query(user_id: int, search_text: str = None, start_date: str = None, end_date: str = None, top_k=10):
+    """Поиск заметок пользователя.
+
+    Если индекс хранит векторы заметок, полнотекстовый поиск (BM25) и поиск по близости векторов
+    выполняются параллельно, а их результаты объединяются методом RRF.
+    """
     try:
+        filters = build_notes_filters(user_id, start_date, end_date)
         must_clauses = []
 
         # Полнотекстовый поиск или match_all
@@ -149,77 +331,222 @@ def get_notes_by_query(user_id: int, search_text: str = None, start_date: str =
                     "fields": ["Title^2", "Body", "Tags^1.5"]
                 }
             })
+        text_query = {"bool": {"filter": filters, "must": must_clauses}}
 
-        # Диапазонный фильтр по дате
-        if start_date or end_date:
-            date_range = {}
-            if start_date:
-                date_range["gte"] = start_date
-            if end_date:
-                date_range["lte"] = end_date
-
-            must_clauses.append({
-                "range": {
-                    "CreatedDate": date_range
-                }
-            })
+        if not search_text or search_text == "*" or not is_hybrid_search_available():
+            return await search_notes(user_id, text_query, top_k)
 
-        search_query = {
-            "query": {
-                "bool": {
-                    "filter": {
-                        "term": {
-                            "UserId": str(user_id)
-                        }
-                    },
-                    "must": must_clauses
-                }
-            },
-            "size": top_k
+        # Кандидатов из каждого поиска берем с запасом, чтобы объединение было осмысленным
+        candidates = top_k * 3
+        try:
+            query_vector = (await get_embeddings([search_text]))[0]
+        except Exception as e:
+            logging.error(f"Не удалось получить вектор запроса, используется только полнотекстовый поиск: {e}")
+            return await search_notes(user_id, text_query, top_k)
+        if is_zero_vector(query_vector):
+            # В запросе нет слов - сравнивать по косинусу не с чем
+            return await search_notes(user_id, text_query, top_k)
+        vector_query = {
+            "script_score": {
+                "query": {"bool": {"filter": filters}},
+                "script": {
+                    # Заметки без вектора получают оценку 0 и отсекаются min_score
+                    "source": "doc['Embedding'].size() == 0 ? 0 : cosineSimilarity(params.query_vector, 'Embedding') + 1.0",
+                    "params": {"query_vector": query_vector},
+                },
+                # Оценка - сходство + 1, чтобы она не была отрицательной
+                "min_score": notes_vector_min_similarity + 1.0,
+            }
         }
-
-        response = es.search(index=notes_index_name, body=search_query)
-        documents = rebuild_response(response)
-        return documents
+        text_documents, vector_documents = await asyncio.gather(
+            search_notes(user_id, text_query, candidates),
+            search_notes(user_id, vector_query, candidates),
+            return_exceptions=True,
+        )
+        if isinstance(text_documents, BaseException):
+            raise text_documents
+        if isinstance(vector_documents, BaseException):
+            logging.error(f"Ошибка поиска по векторам, используется только полнотекстовый поиск: {vector_documents}")
+            return text_documents[:top_k]
+        return fuse_rankings([text_documents, vector_documents], top_k)
     except Exception as e:
         logging.error("Ошибка при поиске в ElasticSearch", exc_info=True)
         return []
 
 
-def get_all_user_notes(user_id:int):
-    try:
-        # Составление запроса
-        search_query = {
-            "query": {
-                "bool": {
-                    "filter": {
-                        "term": {
-                            "UserId": str(user_id)
-                        }
-                    },
-                }
-            },
-        }
+# Стабильный порядок для постраничной выдачи: новые заметки первыми, при равном времени - по идентификатору.
+# В индексах, созданных до появления поля NoteId, его заполняет notes_migration.py backfill
+notes_page_sort = [{"CreatedDate": {"order": "desc"}}, {"NoteId": {"order": "asc", "unmapped_type": "keyword"}}]
+
+async def get_user_notes_page(user_id:int, page_size:int=50, search_after:list=None):
+    """Возвращает страницу заметок пользователя, значение search_after для следующей страницы и общее количество.
+
+    Следующей страницы нет, если возвращено меньше page_size заметок.
+    """
+    search_query = {
+        "query": {
+            "bool": {
+                "filter": {
+                    "term": {
+                        "UserId": str(user_id)
+                    }
+                },
+            }
+        },
+        "sort": notes_page_sort,
+        "size": page_size,
+        "_source": {"excludes": notes_source_excludes},
+        "track_total_hits": True,
+    }
+    if search_after is not None:
+        search_query["search_after"] = search_after
+    response = await get_connection().search(index=notes_index_name, body=search_query, routing=await get_routing(user_id),
+                                             request_timeout=elastic_search_timeout)
+    hits = response['hits']['hits']
+    documents = rebuild_response(response)
+    next_search_after = hits[-1]["sort"] if len(hits) == page_size else None
+    return documents, next_search_after, response['hits']['total']['value']
+
+# Максимальное количество операций в одном запросе _bulk
+bulk_chunk_size = int(os.getenv('ELASTIC_BULK_CHUNK_SIZE', '500'))
+
+async def get_note_owners(note_ids:list, routing=None) -> dict:
+    """Возвращает владельцев существующих заметок: {идентификатор заметки: идентификатор пользователя}.
+
+    Документы читаются через mget, который, в отличие от поиска, видит еще не обновленные записи.
+    С маршрутизацией проверяется только шард пользователя - туда же выполняется и запись.
+    """
+    if not note_ids:
+        return {}
+    docs = []
+    for note_id in note_ids:
+        doc = {"_id": str(note_id), "_source": ["UserId"]}
+        if routing is not None:
+            doc["routing"] = routing
+        docs.append(doc)
+    response = await get_connection().mget(index=notes_index_name, body={"docs": docs},
+                                           request_timeout=elastic_search_timeout)
+    for doc in response["docs"]:
+        if doc.get("error", {}).get("type") == "routing_missing_exception":
+            raise RoutingMissingError(doc["error"].get("reason"))
+    return {doc["_id"]: str(doc["_source"].get("UserId")) for doc in response["docs"] if doc.get("found")}
+
+async def execute_bulk(operations:list[list[dict]]) -> list[dict]:
+    """Выполняет операции через _bulk пачками и возвращает результат по каждой операции.
+
+    Операция - список строк запроса _bulk: действие и, для index/update, тело документа.
+    """
+    items = []
+    for start in range(0, len(operations), bulk_chunk_size):
+        body = [line for operation in operations[start:start + bulk_chunk_size] for line in operation]
+        response = await get_connection().bulk(body=body, index=notes_index_name,
+                                               refresh="wait_for", request_timeout=elastic_timeout)
+        for item in response["items"]:
+            operation, result = next(iter(item.items()))
+            if result.get("error", {}).get("type") == "routing_missing_exception":
+                # Без маршрутизации в такой индекс не записывается ни одна операция пачки
+                raise RoutingMissingError(result["error"].get("reason"))
+            items.append({
+                "NoteId": result["_id"],
+                "operation": operation,
+                "status": result["status"],
+                "result": result.get("result"),
+                "error": result.get("error", {}).get("reason") if "error" in result else None,
+            })
+    return items
+
+def bulk_metadata(note_id, routing, **params) -> dict:
+    metadata = {"_id": note_id, **params}
+    if routing is not None:
+        metadata["routing"] = routing
+    return metadata
+
+async def remove_notes(user_id:int, note_ids:list) -> dict:
+    """Удаляет заметки пользователя одним запросом _bulk.
+
+    Заметки других пользователей не удаляются и попадают в not_found вместе с несуществующими.
+    """
+    note_ids = list(dict.fromkeys(str(note_id) for note_id in note_ids))
+    report = {"deleted": [], "not_found": [], "failed": []}
+
+    async def delete_owned(routing):
+        owners = await get_note_owners(note_ids, routing)
+        owned_ids = [note_id for note_id in note_ids if owners.get(note_id) == str(user_id)]
+        if not owned_ids:
+            return owned_ids, []
+        return owned_ids, await execute_bulk([[{"delete": bulk_metadata(note_id, routing)}] for note_id in owned_ids])
 
-        # Выполнение запроса
-        response = es.search(index=notes_index_name, body=search_query)
-        # Вывод результатов
-        documents = rebuild_response(response)
-        return documents
-    except Exception as e:
-        logging.error("Ошибка при поиске в ElasticSearch", exc_info=True)
-        return []
-def remove_note(note_id:int):
     try:
-        es.delete(index=notes_index_name, id=note_id)
-        return True
+        owned_ids, items = await with_user_routing(user_id, delete_owned)
+        report["not_found"] = [note_id for note_id in note_ids if note_id not in owned_ids]
+        for item in items:
+            if item["result"] == "deleted":
+                report["deleted"].append(item["NoteId"])
+            elif item["status"] == 404:
+                report["not_found"].append(item["NoteId"])
+            else:
+                report["failed"].append(item)
     except Exception as e:
         logging.error("Ошибка при удалении в ElasticSearch", exc_info=True)
-        return False
+        report["failed"].extend({"NoteId": note_id, "error": str(e)} for note_id in note_ids
+                                if note_id not in report["deleted"] and note_id not in report["not_found"])
+    logging.info(f"Удаление заметок пользователя {user_id}: удалено {len(report['deleted'])}, "
+                 f"не найдено {len(report['not_found'])}, ошибок {len(report['failed'])}")
+    return report
 
-async def remove_notes(note_ids:list[int]):
-    for note_id in note_ids:
-        remove_note(note_id)
+async def import_notes(user_id:int, notes:list[dict]) -> dict:
+    """Загружает заметки пользователя одним запросом _bulk (создание или обновление).
+
+    Заметка с NoteId обновляется, если принадлежит пользователю; NoteId чужой заметки отклоняется.
+    Заметки без NoteId получают новые идентификаторы.
+    """
+    report = {"created": [], "updated": [], "failed": []}
+
+    async def write_notes(routing):
+        rejected = []
+        owners = await get_note_owners([note["NoteId"] for note in notes if note.get("NoteId")], routing)
+        # Новые идентификаторы в миллисекундах не пересекаются с идентификаторами add_note в секундах
+        next_id = int(datetime.now(timezone.utc).timestamp() * 1000)
+        now = get_elastic_datetime_now_utc()
+        operations = []
+        for note in notes:
+            note_id = str(note["NoteId"]) if note.get("NoteId") else None
+            if note_id is not None and note_id in owners and owners[note_id] != str(user_id):
+                rejected.append({"NoteId": note_id, "error": "Заметка принадлежит другому пользователю"})
+                continue
+            if note_id is None:
+                note_id = str(next_id)
+                next_id += 1
+            document = {
+                "UserId": user_id,
+                "NoteId": note_id,
+                "Title": note["Title"],
+                "Body": str(note.get("Body", "")),
+                "Tags": note.get("Tags", []),
+                "CreatedDate": note.get("CreatedDate") or now,
+                "UpdatedAt": now,
+            }
+            operations.append([{"update": bulk_metadata(note_id, routing, retry_on_conflict=elastic_retry_on_conflict)},
+                               {"doc": document, "doc_as_upsert": True}])
+        await attach_embeddings([operation[1]["doc"] for operation in operations])
+        return rejected, await execute_bulk(operations) if operations else []
+
+    try:
+        rejected, items = await with_user_routing(user_id, write_notes)
+        report["failed"].extend(rejected)
+        for item in items:
+            if item["error"] is not None:
+                report["failed"].append({"NoteId": item["NoteId"], "error": item["error"]})
+            elif item["result"] == "created":
+                report["created"].append(item["NoteId"])
+            else:
+                report["updated"].append(item["NoteId"])
+    except Exception as e:
+        logging.error("Ошибка при загрузке заметок в ElasticSearch", exc_info=True)
+        report["failed"].append({"NoteId": None, "error": str(e)})
+    logging.info(f"Загрузка заметок пользователя {user_id}: создано {len(report['created'])}, "
+                 f"обновлено {len(report['updated'])}, ошибок {len(report['failed'])}")
+    return report
 
 
 def rebuild_response(response):
@@ -231,6 +558,9 @@ def rebuild_response(response):
         document = hit["_source"]
         document['NoteId'] = hit["_id"]
         document['Score'] = hit["_score"]
+        # Значения сортировки нужны для продолжения постраничной выдачи
+        if "sort" in hit:
+            document['Sort'] = hit["sort"]
         logging.info(f"ID документа: { document['NoteId']}")
         logging.info(f"Источник: {document}")
         documents.append(document)
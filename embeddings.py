@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import re
+import time
+from array import array
+
+from local_db import connect_sqlite, get_local_db_path
+
+embeddings_table_name = 'embeddings'
+
+# Размерность векторов должна совпадать с маппингом поля Embedding индекса заметок
+embedding_dimensions = int(os.getenv('EMBEDDING_DIMENSIONS', '256'))
+# Сколько текстов отправлять провайдеру за один запрос
+embedding_batch_size = int(os.getenv('EMBEDDING_BATCH_SIZE', '256'))
+# Таймаут и ограничение одновременных запросов к embeddings API
+embedding_timeout = float(os.getenv('OPENAI_EMBEDDINGS_TIMEOUT', '30'))
+embedding_semaphore = asyncio.Semaphore(int(os.getenv('OPENAI_EMBEDDINGS_CONCURRENCY', '4')))
+
+# Общий клиент OpenAI бота, задается при старте. Без него (notes_migration.py) провайдер создает свой клиент
+shared_openai_client = None
+
+
+def use_openai_client(client):
+    global shared_openai_client
+    shared_openai_client = client
+
+
+class OpenAIEmbeddingProvider:
+    """Векторы текстов через OpenAI embeddings API."""
+
+    def __init__(self, model="text-embedding-3-small", dimensions=embedding_dimensions):
+        self.name = f"openai:{model}"
+        self.model = model
+        self.dimensions = dimensions
+        self.client = None
+
+    def get_client(self):
+        if shared_openai_client is not None:
+            return shared_openai_client
+        if self.client is None:
+            from openai import AsyncOpenAI
+            self.client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), timeout=embedding_timeout, max_retries=2)
+        return self.client
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        async with embedding_semaphore:
+            response = await self.get_client().embeddings.create(model=self.model, input=texts, dimensions=self.dimensions,
+                                                                 timeout=embedding_timeout)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    async def close(self):
+        # Общий клиент закрывается вместе с ботом
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+
+class HashingEmbeddingProvider:
+    """Детерминированные векторы по хэшам слов и их триграмм. Не требует сети - для тестов и разработки."""
+
+    def __init__(self, dimensions=embedding_dimensions):
+        self.name = "hashing"
+        self.dimensions = dimensions
+
+    def _features(self, text: str):
+        for word in re.findall(r"\w+", text.lower().replace("ё", "е")):
+            yield word
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3]
+
+    def embed_one(self, text: str) -> list[float]:
+        vector = [0.0] * self.dimensions
+        for feature in self._features(text):
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dimensions
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector))
+        return [value / norm for value in vector] if norm > 0 else vector
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_one(text) for text in texts]
+
+    async def close(self):
+        pass
+
+
+class EmbeddingCache:
+    """Постоянный кэш векторов в локальной SQLite-базе по хэшу содержимого текста.
+
+    Ключ включает провайдера и размерность, поэтому смена модели не возвращает чужие векторы.
+    При превышении max_entries удаляются давно не использованные записи.
+    """
+
+    def __init__(self, path, max_entries=100000):
+        self.connection = connect_sqlite(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {embeddings_table_name} (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                used_at REAL NOT NULL
+            )
+        """)
+        self.connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {embeddings_table_name}_used_at ON {embeddings_table_name} (used_at)")
+
+    def get_many(self, keys: list[str]) -> dict:
+        rows = []
+        # Ограничение SQLite на количество параметров запроса
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows += self.connection.execute(
+                f"SELECT key, vector FROM {embeddings_table_name} WHERE key IN ({', '.join('?' * len(batch))})",
+                batch).fetchall()
+        vectors = {}
+        for key, blob in rows:
+            vector = array("f")
+            vector.frombytes(blob)
+            vectors[key] = vector.tolist()
+        self.hits += len(vectors)
+        self.misses += len(set(keys)) - len(vectors)
+        if vectors:
+            now = time.time()
+            self.connection.executemany(
+                f"UPDATE {embeddings_table_name} SET used_at = ? WHERE key = ?", [(now, key) for key in vectors])
+        return vectors
+
+    def put_many(self, vectors: dict):
+        now = time.time()
+        self.connection.executemany(
+            f"INSERT OR REPLACE INTO {embeddings_table_name} (key, vector, used_at) VALUES (?, ?, ?)",
+            [(key, array("f", vector).tobytes(), now) for key, vector in vectors.items()])
+        self._evict()
+
+    def _evict(self):
+        count = self.connection.execute(f"SELECT COUNT(*) FROM {embeddings_table_name}").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(f"""
+                DELETE FROM {embeddings_table_name} WHERE rowid IN (
+                    SELECT rowid FROM {embeddings_table_name} ORDER BY used_at LIMIT ?
+                )
+            """, (count - self.max_entries,))
+            logging.info(f"Из кэша векторов удалено записей: {count - self.max_entries}")
+
+    def get_stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# Провайдер и кэш создаются при первом обращении
+embedding_provider = None
+embedding_cache = None
+
+
+def create_embedding_provider_from_os():
+    """Провайдер векторов по EMBEDDING_PROVIDER: openai, hashing или none (семантический поиск выключен)."""
+    provider_name = os.getenv('EMBEDDING_PROVIDER', 'openai').lower()
+    if provider_name == 'none':
+        return None
+    if provider_name == 'openai':
+        return OpenAIEmbeddingProvider(os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small'))
+    if provider_name == 'hashing':
+        return HashingEmbeddingProvider()
+    raise ValueError(f"Неизвестный провайдер векторов: {provider_name}")
+
+
+def get_embedding_provider():
+    global embedding_provider
+    if embedding_provider is None:
+        embedding_provider = create_embedding_provider_from_os()
+    return embedding_provider
+
+
+def is_semantic_search_enabled() -> bool:
+    return get_embedding_provider() is not None
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global embedding_cache
+    if embedding_cache is None:
+        embedding_cache = EmbeddingCache(
+            get_local_db_path(os.getenv('EMBEDDING_CACHE_DB_FILE', 'embeddings.sqlite')),
+            max_entries=int(os.getenv('EMBEDDING_CACHE_SIZE', '100000')),
+        )
+    return embedding_cache
+
+
+def is_zero_vector(vector: list[float]) -> bool:
+    """Нулевой вектор (текст без слов) нельзя сравнивать по косинусу: результат не определен."""
+    return not any(vector)
+
+
+def get_note_embedding_text(title: str, body: str, tags: list) -> str:
+    return f"{title}\n{body}\n{' '.join(tags or [])}".strip()
+
+
+def get_cache_key(provider, text: str) -> str:
+    return f"{provider.name}:{provider.dimensions}:{hashlib.sha256(text.encode()).hexdigest()}"
+
+
+async def get_embeddings(texts: list[str]) -> list[list[float]]:
+    """Векторы текстов. Уже посчитанные берутся из кэша, остальные запрашиваются пакетами."""
+    provider = get_embedding_provider()
+    cache = get_embedding_cache()
+    keys = [get_cache_key(provider, text) for text in texts]
+    vectors = cache.get_many(list(dict.fromkeys(keys)))
+    missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+    missing_keys = list(missing)
+    for start in range(0, len(missing_keys), embedding_batch_size):
+        batch = missing_keys[start:start + embedding_batch_size]
+        computed = dict(zip(batch, await provider.embed([missing[key] for key in batch])))
+        cache.put_many(computed)
+        vectors.update(computed)
+    return [vectors[key] for key in keys]
+
+
+async def close_embeddings():
+    if embedding_provider is not None:
+        await embedding_provider.close()
@@ -0,0 +1,112 @@
+import logging
+import os
+import re
+import time
+
+from local_db import connect_sqlite, get_local_db_path
+
+forward_table_name = 'geocode_forward'
+reverse_table_name = 'geocode_reverse'
+
+
+def normalize_address(address: str) -> str:
+    """Приводит адрес к виду, в котором одинаковые запросы совпадают."""
+    address = address.lower().replace("ё", "е")
+    return re.sub(r"[\s,.;]+", " ", address).strip()
+
+
+class GeocodeCache:
+    """Постоянный кэш геокодирования в локальной SQLite-базе.
+
+    Прямое геокодирование кэшируется по нормализованному адресу, обратное - по координатам,
+    округленным до coordinate_digits знаков. Размер каждой таблицы ограничен max_entries,
+    при превышении удаляются давно не использованные записи.
+    """
+
+    def __init__(self, path, max_entries=10000, coordinate_digits=4):
+        self.connection = connect_sqlite(path)
+        self.max_entries = max_entries
+        self.coordinate_digits = coordinate_digits
+        self.hits = 0
+        self.misses = 0
+        self.connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {forward_table_name} (
+                query TEXT PRIMARY KEY,
+                latitude REAL NOT NULL,
+                longitude REAL NOT NULL,
+                used_at REAL NOT NULL
+            )
+        """)
+        self.connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {reverse_table_name} (
+                latitude REAL NOT NULL,
+                longitude REAL NOT NULL,
+                address TEXT NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (latitude, longitude)
+            )
+        """)
+        for table_name in (forward_table_name, reverse_table_name):
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_used_at ON {table_name} (used_at)")
+
+    def _quantize(self, latitude, longitude):
+        return round(float(latitude), self.coordinate_digits), round(float(longitude), self.coordinate_digits)
+
+    def get_location(self, address: str):
+        query = normalize_address(address)
+        row = self.connection.execute(
+            f"SELECT latitude, longitude FROM {forward_table_name} WHERE query = ?", (query,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute(f"UPDATE {forward_table_name} SET used_at = ? WHERE query = ?", (time.time(), query))
+        return row[0], row[1]
+
+    def put_location(self, address: str, latitude, longitude):
+        self.connection.execute(
+            f"INSERT OR REPLACE INTO {forward_table_name} (query, latitude, longitude, used_at) VALUES (?, ?, ?, ?)",
+            (normalize_address(address), latitude, longitude, time.time()))
+        self._evict(forward_table_name)
+
+    def get_address(self, latitude, longitude):
+        latitude, longitude = self._quantize(latitude, longitude)
+        row = self.connection.execute(
+            f"SELECT address FROM {reverse_table_name} WHERE latitude = ? AND longitude = ?",
+            (latitude, longitude)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute(
+            f"UPDATE {reverse_table_name} SET used_at = ? WHERE latitude = ? AND longitude = ?",
+            (time.time(), latitude, longitude))
+        return row[0]
+
+    def put_address(self, latitude, longitude, address: str):
+        latitude, longitude = self._quantize(latitude, longitude)
+        self.connection.execute(
+            f"INSERT OR REPLACE INTO {reverse_table_name} (latitude, longitude, address, used_at) VALUES (?, ?, ?, ?)",
+            (latitude, longitude, address, time.time()))
+        self._evict(reverse_table_name)
+
+    def _evict(self, table_name):
+        count = self.connection.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(f"""
+                DELETE FROM {table_name} WHERE rowid IN (
+                    SELECT rowid FROM {table_name} ORDER BY used_at LIMIT ?
+                )
+            """, (count - self.max_entries,))
+            logging.info(f"Из кэша геокодирования {table_name} удалено записей: {count - self.max_entries}")
+
+    def get_stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def create_geocode_cache_from_os() -> GeocodeCache:
+    return GeocodeCache(
+        get_local_db_path(os.getenv('GEOCODE_CACHE_DB_FILE', 'geocode_cache.sqlite')),
+        max_entries=int(os.getenv('GEOCODE_CACHE_SIZE', '10000')),
+        coordinate_digits=int(os.getenv('GEOCODE_REVERSE_DIGITS', '4')),
+    )
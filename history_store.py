@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+import mysql.connector
+
+from local_db import connect_sqlite, get_local_db_path
+from sql import MYSQL_HOST, execute_query
+
+history_table_name = 'user_histories'
+
+# Признак отсутствия записи в памяти
+_missing = object()
+
+
+class NullHistoryBackend:
+    """История хранится только в памяти процесса."""
+
+    def open(self):
+        pass
+
+    def load(self, user_id):
+        return None
+
+    def save_many(self, histories: dict[int, str]):
+        pass
+
+
+class SqliteHistoryBackend:
+    """Хранение истории бесед в локальной SQLite-базе."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        # Соединение используется из рабочих потоков
+        self.lock = threading.Lock()
+
+    def open(self):
+        self.connection = connect_sqlite(self.path)
+        self.connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {history_table_name} (
+                user_id INTEGER PRIMARY KEY,
+                history TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def load(self, user_id):
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT history FROM {history_table_name} WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_many(self, histories: dict[int, str]):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {history_table_name} (user_id, history, updated_at) VALUES (?, ?, ?)",
+                [(user_id, history, now) for user_id, history in histories.items()])
+
+
+class MySqlHistoryBackend:
+    """Хранение истории бесед в MySQL."""
+
+    def open(self):
+        try:
+            execute_query(f"""
+                CREATE TABLE IF NOT EXISTS {history_table_name} (
+                    user_id BIGINT PRIMARY KEY,
+                    history MEDIUMTEXT CHARACTER SET utf8mb4 NOT NULL,
+                    updated_at DATETIME NOT NULL
+                )
+            """)
+        except mysql.connector.Error as err:
+            logging.error(f"Ошибка создания таблицы в MySQL: {err}")
+            raise
+
+    def load(self, user_id):
+        rows = execute_query(f"SELECT history FROM {history_table_name} WHERE user_id = %s", (user_id,), fetch=True)
+        return json.loads(rows[0][0]) if rows else None
+
+    def save_many(self, histories: dict[int, str]):
+        execute_query(f"""
+            INSERT INTO {history_table_name} (user_id, history, updated_at) VALUES (%s, %s, UTC_TIMESTAMP())
+            ON DUPLICATE KEY UPDATE history = VALUES(history), updated_at = VALUES(updated_at)
+            """, list(histories.items()), many=True)
+
+
+class PersistentHistoryStore:
+    """История бесед в памяти с отложенной пакетной записью в хранилище.
+
+    История пользователя загружается из хранилища при первом обращении. Изменения
+    накапливаются в памяти и записываются пачкой раз в flush_interval секунд,
+    поэтому сохранение не добавляет задержки к обработке сообщения.
+    """
+
+    def __init__(self, store, backend, flush_interval=5.0):
+        self.store = store
+        self.name = store.name
+        self.backend = backend
+        self.flush_interval = flush_interval
+        # Измененные, но еще не записанные истории. Вытесненная из памяти история
+        # остается здесь до записи, поэтому изменения не теряются.
+        self.dirty = {}
+        self.loads = 0
+        self.flushed = 0
+
+    async def open(self):
+        """Подготавливает хранилище. Вызывается при старте бота, после подключения к базе данных."""
+        await asyncio.to_thread(self.backend.open)
+
+    async def _load(self, key, value):
+        if value is not _missing:
+            return value
+        value = self.dirty.get(key, _missing)
+        if value is not _missing:
+            return value
+        self.loads += 1
+        # Пустая история тоже остается в памяти, чтобы не обращаться к хранилищу на каждом сообщении
+        value = await asyncio.to_thread(self.backend.load, key)
+        return [] if value is None else value
+
+    async def get(self, key, default_value):
+        value = await self.store.update(key, lambda value: self._load(key, value), _missing)
+        return default_value if value is None else value
+
+    async def set(self, key, value):
+        await self.store.set(key, value)
+        self.dirty[key] = value if value is not None else []
+
+    async def delete(self, key):
+        await self.set(key, [])
+
+    async def update(self, key, fn, default_value=None):
+        async def load_and_apply(value):
+            value = await self._load(key, value)
+            return fn(default_value if value is None else value)
+        result = await self.store.update(key, load_and_apply, _missing)
+        self.dirty[key] = result if result is not None else []
+        return result
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        # Сериализуем в цикле событий: списки истории могут изменяться, пока идет запись
+        payload = {key: json.dumps(value, ensure_ascii=False) for key, value in batch.items()}
+        try:
+            await asyncio.to_thread(self.backend.save_many, payload)
+            self.flushed += len(payload)
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении истории: {e}")
+            # Возвращаем несохраненные истории, если их не успели изменить заново
+            for key, value in batch.items():
+                self.dirty.setdefault(key, value)
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def get_stats(self) -> dict:
+        stats = self.store.get_stats()
+        stats.update({"dirty": len(self.dirty), "loads": self.loads, "flushed": self.flushed})
+        return stats
+
+
+def create_history_store_from_os(store):
+    """Создает историю бесед с хранилищем, заданным HISTORY_BACKEND (sqlite, mysql или memory).
+
+    По умолчанию история хранится в MySQL, если он настроен: локальный файл SQLite на Render
+    не переживает деплой и подходит только для постоянного диска или локального запуска.
+    """
+    backend_name = os.getenv('HISTORY_BACKEND', 'mysql' if MYSQL_HOST else 'sqlite').lower()
+    if backend_name == 'memory':
+        backend = NullHistoryBackend()
+    elif backend_name == 'mysql':
+        backend = MySqlHistoryBackend()
+    elif backend_name == 'sqlite':
+        backend = SqliteHistoryBackend(get_local_db_path(os.getenv('HISTORY_DB_FILE', 'history.sqlite')))
+    else:
+        raise ValueError(f"Неизвестное хранилище истории: {backend_name}")
+    logging.info(f"History backend: {backend_name}")
+    return PersistentHistoryStore(store, backend, float(os.getenv('HISTORY_FLUSH_INTERVAL', '5')))
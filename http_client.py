@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+# Ошибки HTTP-запросов, которые обрабатывают вызывающие функции
+HTTP_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+# Статусы, при которых запрос стоит повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+http_timeout = float(os.getenv('HTTP_TIMEOUT', '10'))
+http_retries = int(os.getenv('HTTP_RETRIES', '2'))
+http_retry_backoff = float(os.getenv('HTTP_RETRY_BACKOFF', '0.5'))
+# Таймаут запроса по умолчанию. Передается в каждый запрос явно: timeout=None в aiohttp означает
+# отсутствие таймаута, а не таймаут сессии
+default_timeout = aiohttp.ClientTimeout(total=http_timeout, connect=5)
+
+# Общая сессия с пулом соединений для внешних API (погода, геокодер)
+session = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    global session
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=int(os.getenv('HTTP_MAX_CONNECTIONS', '50')),
+            limit_per_host=int(os.getenv('HTTP_MAX_CONNECTIONS_PER_HOST', '10')),
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=default_timeout,
+        )
+    return session
+
+
+async def get_json(url, params=None, timeout=None, retries=None):
+    """GET-запрос с разбором JSON-ответа.
+
+    Ошибки соединения, таймауты и статусы из RETRY_STATUSES повторяются не более retries раз
+    с экспоненциальной паузой. Остальные ошибки HTTP пробрасываются сразу.
+    """
+    retries = http_retries if retries is None else retries
+    request_timeout = aiohttp.ClientTimeout(total=timeout, connect=5) if timeout is not None else default_timeout
+    for attempt in range(retries + 1):
+        try:
+            async with get_session().get(url, params=params, timeout=request_timeout) as response:
+                if response.status in RETRY_STATUSES and attempt < retries:
+                    logging.warning(f"{url} вернул {response.status}, попытка {attempt + 1} из {retries + 1}")
+                else:
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt >= retries:
+                raise
+            logging.warning(f"Ошибка запроса к {url}: {e!r}, попытка {attempt + 1} из {retries + 1}")
+        await asyncio.sleep(http_retry_backoff * 2 ** attempt)
+
+
+async def close_session():
+    global session
+    if session is not None and not session.closed:
+        await session.close()
+    session = None
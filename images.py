@@ -0,0 +1,159 @@
+import asyncio
+import base64
+import io
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from state_store import memory_budget
+
+# Vision-модель в режиме detail=high вписывает изображение в 2048x2048, а затем
+# уменьшает короткую сторону до 768 - больше отправлять бессмысленно
+image_max_long_side = int(os.getenv('IMAGE_MAX_LONG_SIDE', '2048'))
+image_max_short_side = int(os.getenv('IMAGE_MAX_SHORT_SIDE', '768'))
+image_jpeg_quality = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+# Сколько символов ответа модели сохранять в истории как описание изображения
+image_description_length = int(os.getenv('IMAGE_DESCRIPTION_LENGTH', '500'))
+
+
+def prepare_image(image_bytes: bytes) -> bytes:
+    """Уменьшает изображение до разрешения, используемого моделью, и пережимает в JPEG."""
+    # Pillow загружается при первой обработке изображения, а не при старте бота
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(image_bytes)) as source:
+        image = ImageOps.exif_transpose(source)
+        width, height = image.size
+        scale = min(1.0, image_max_long_side / max(width, height), image_max_short_side / min(width, height))
+        if scale < 1.0:
+            image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=image_jpeg_quality, optimize=True)
+    return output.getvalue()
+
+
+async def ingest_image(image_bytes: bytes) -> dict:
+    """Готовит загруженное изображение для vision-запроса. Обработка выполняется вне цикла событий."""
+    prepared = await asyncio.to_thread(prepare_image, image_bytes)
+    logging.info(f"Изображение подготовлено: {len(image_bytes)} -> {len(prepared)} байт")
+    return {"image_type": "image/jpeg", "image": prepared}
+
+
+def get_image_data_url(image: dict) -> str:
+    img_b64_str = base64.b64encode(image["image"]).decode("utf-8")
+    return f"data:{image['image_type']};base64,{img_b64_str}"
+
+
+def build_image_message(user_message: str, image: dict) -> dict:
+    """Сообщение пользователя с изображением, передаваемым в запросе целиком."""
+    return {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": user_message},
+            {
+                "type": "image_url",
+                "image_url": {"url": get_image_data_url(image)},
+            },
+        ],
+    }
+
+
+def is_image_message(message: dict) -> bool:
+    content = message.get("content")
+    return isinstance(content, list) and any(part.get("type") == "image_url" for part in content)
+
+
+def compact_image_message(message: dict, description: str = None) -> dict:
+    """Заменяет изображение в сообщении на короткую текстовую ссылку на него.
+
+    Изображение передается модели только в том ходе, в котором о нем спросили,
+    а в истории остается текст вопроса и описание изображения.
+    """
+    text = " ".join(part["text"] for part in message["content"] if part.get("type") == "text")
+    reference = "[Пользователь прислал изображение"
+    if description:
+        if len(description) > image_description_length:
+            description = description[:image_description_length] + "…"
+        reference += f". Ответ по изображению: {description}"
+    reference += "]"
+    return {"role": message["role"], "content": f"{text}\n{reference}" if text else reference}
+
+
+def compact_image_messages(history: list[dict], description: str = None):
+    """Заменяет в истории все сообщения с изображениями на текстовые ссылки."""
+    for i, message in enumerate(history):
+        if is_image_message(message):
+            history[i] = compact_image_message(message, description)
+
+
+class ImageStore:
+    """Хранилище загруженных изображений с ограничением общего размера и временем жизни.
+
+    Размер изображений учитывается в общем бюджете памяти вместе с хранилищами состояния.
+    """
+
+    def __init__(self, max_bytes, ttl, budget=memory_budget):
+        self.name = "user_image"
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.budget = budget
+        self.items = OrderedDict()  # ключ -> (время истечения, изображение)
+        self.total_bytes = 0
+        self.evictions = 0
+
+    async def set(self, key, image):
+        self._remove(key)
+        if image is None:
+            return
+        self.items[key] = (time.monotonic() + self.ttl, image)
+        self._account(len(image["image"]))
+        self._evict(key)
+
+    async def get(self, key, default_value):
+        item = self.items.get(key)
+        if item is None:
+            return default_value
+        expires_at, image = item
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return default_value
+        return image
+
+    async def delete(self, key):
+        self._remove(key)
+
+    def _remove(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self._account(-len(item[1]["image"]))
+
+    def _account(self, size):
+        self.total_bytes += size
+        if self.budget is not None:
+            self.budget.used += size
+
+    def _is_overflow(self) -> bool:
+        return self.total_bytes > self.max_bytes or (self.budget is not None and self.budget.is_exceeded())
+
+    def _evict(self, protected_key=None):
+        now = time.monotonic()
+        # Записи добавляются с одинаковым временем жизни, поэтому самые старые - в начале
+        while self.items:
+            key, (expires_at, _) = next(iter(self.items.items()))
+            if key == protected_key or (expires_at >= now and not self._is_overflow()):
+                break
+            self._remove(key)
+            self.evictions += 1
+            logging.info(f"Изображение пользователя {key} удалено из хранилища")
+
+    def get_stats(self) -> dict:
+        return {"entries": len(self.items), "bytes": self.total_bytes, "evictions": self.evictions}
+
+
+def create_image_store_from_os() -> ImageStore:
+    return ImageStore(
+        max_bytes=int(os.getenv('IMAGE_STORE_MAX_BYTES', str(64 * 1024 * 1024))),
+        ttl=float(os.getenv('IMAGE_STORE_TTL', '1800')),
+    )
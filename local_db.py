@@ -0,0 +1,23 @@
+import logging
+import os
+import sqlite3
+
+# Каталог для локальных SQLite-баз. На Render его нужно смонтировать на постоянный диск,
+# иначе данные не переживут деплой.
+LOCAL_DATA_DIR = os.getenv('LOCAL_DATA_DIR', 'data')
+
+
+def get_local_db_path(file_name: str) -> str:
+    os.makedirs(LOCAL_DATA_DIR, exist_ok=True)
+    return os.path.join(LOCAL_DATA_DIR, file_name)
+
+
+def connect_sqlite(path: str) -> sqlite3.Connection:
+    """Открывает SQLite-базу в режиме WAL с автокоммитом."""
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # В режиме WAL при NORMAL данные не теряются при падении процесса, только при отключении питания
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA busy_timeout=5000")
+    logging.info(f"Локальная база открыта: {path}")
+    return connection
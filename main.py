@@ -1,11 +1,8 @@
 import asyncio
-import base64
+import json
 import logging
-import mimetypes
 import os
-import tempfile
 
-from functools import partial
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
@@ -15,20 +12,31 @@ from telegram.ext import (
     filters,
 )
 from aiohttp import web
-from openai import OpenAI
 
-from elastic import get_all_user_notes
-from openai_api import get_model_answer, transcribe_audio
-from state_and_commands import  OpenAI_Models, add_location_button, add_user, get_history, get_last_session, get_local_time, get_notes_text, get_user_image, info, list_users, remove_user, reply_service_text, reply_text, reset, set_bot_version, set_session_info, set_user_image, start
-from sql import get_admins, in_user_list
-from yandex_maps import get_address
+from common_types import StageTimer
+from dispatcher import create_dispatcher_from_os
+from elastic import close_elastic, import_notes, init_elastic
+from embeddings import close_embeddings, get_embedding_cache, use_openai_client
+from http_client import close_session
+from images import build_image_message, compact_image_messages, ingest_image
+from notes_import import check_notes_file, parse_notes_file
+from notes_pages import get_notes_page
+from openai_api import create_openai_client, get_model_answer, transcribe_audio
+from prompt import build_messages, get_fixed_prompt_tokens, get_prompt_cache_stats
+from token_budget import get_prompt_token_limit, trim_history
+from streaming_reply import StreamingReply, is_stream_replies_enabled
+from state_and_commands import  OpenAI_Models, add_location_button, add_user, get_history, get_last_session, get_session_activity, get_state_stats, get_user_image, get_user_model, info, list_users, remove_user, reply_service_text, reply_text, reset, set_bot_version, set_session_info, set_user_image, start
+from spool import create_spool_from_os
+from sql import get_admins, in_user_list, init_db, run_user_ids_refresher
+from weather import weather_cache
+from yandex_maps import get_address, get_geocode_cache
 
 
 version="12.00"
 
-# Инициализация OpenAI и Telegram API
+# Инициализация OpenAI и Telegram API. Клиент OpenAI создается при старте бота
 opena_ai_api_key=os.getenv('OPENAI_API_KEY')
-openai_client = OpenAI(api_key=opena_ai_api_key)
+openai_client = None
 
 telegram_token = os.getenv('TELEGRAM_BOT_TOKEN')
 
@@ -37,84 +45,47 @@ logger=logging.getLogger(__name__)
 # URL вебхука
 WEBHOOK_URL = "https://telegram-bot-xmj4.onrender.com/telegram-webhook"
 
-def get_system_message():
-    # Сообщение системы для пользователя
-    local_time = get_local_time()
-    system_message = {
-        "role": "system",
-        "content": 
-f"""
-Вы — личный помощник, который отвечает на вопросы пользователя. Время по Москве — {local_time}. 
-1. Если для ответа на вопрос пользователя требуется прогноз погоды и он уже есть в истории сообщений или системной информации, используй его. В противном случае вызови функцию get_weather_description.
-
-2. Если для ответа требуется геолокация пользователя и она доступна в истории сообщений или системной информации, используй ее. Иначе запроси геолокацию через функцию request_geolocation.
-
-3. Если пользователь просит сгенерировать изображение, используй функцию generate_image.
-
-4. Если пользователь хочет что-то сохранить, добавь это в заметки в базе Elasticsearch, используя функцию add_note. Если в заметках присутствуют относительные временные указания (например, дни недели, "завтра", "в прошлом месяце"), по возможности, преобразуй их в точные даты относительно текущей и сохрани эти даты в заметках.
-
-5. Для умного поиска заметок в Elasticsearch используй функцию get_notes_by_query. Поиск можно выполнять по полям Title, Body, Tags.
-    - Если пользователь запрашивает заметку о событии, используя относительное время, преобразуй его в абсолютное (точная дата, номер недели в году, название месяца) и используй при поиске по search_query.
-    - Для поиска заметок по дате создания используй параметры функции start_created_date и end_created_date.
-    - На вопрос о поиске событий в заметках не используй параметры start_created_date и end_created_date, потому что они о создании заметки, а не о событии внутри нее.
-
-6. Ответ преобразуй в ответ в разметке MarkdownV2, экранируя соответсвующие символы.
-""",
-    }
-    return system_message
-
-max_history_length = 15  # Максимальное количество сообщений в истории
-
 user_histories=get_history()
 
-administrators_ids = get_admins()
-
-async def get_bot_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message):
+async def get_bot_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message, stream_reply=None):
+    user_id = update.effective_user.id
     try:
-        imgage_dict = await get_user_image(update.effective_user.id)
+        imgage_dict = await get_user_image(user_id)
         if imgage_dict is not None:
             try:
-                # Итоговая строка для использования
-                img_type=imgage_dict["image_type"]
-                img_b64_str = imgage_dict["image"]
-                history = await user_histories.get(update.effective_user.id, [])
-                history.append({
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": user_message},
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:{img_type};base64,{img_b64_str}"},
-                        },
-                    ],
-                })
+                history = await get_history(user_id, build_image_message(user_message, imgage_dict))
             except Exception as e:
                 logger.error(f"Ошибка при при обработке вашего запроса c изображением: {e}")
                 return "Извините, произошла ошибка при обработке вашего запроса c изображением."
             finally:
-                await set_user_image(update.effective_user.id, None)
+                await set_user_image(user_id, None)
         else:
             # Получаем или создаем историю сообщений для пользователя
-            history = await get_history(update.effective_user.id, user_message)
+            history = await get_history(user_id, user_message)
     
-   
-        system_message= get_system_message()
-        logger.info([system_message] + history)
+        messages = build_messages(history)
+        logger.info(messages)
         
         
-        bot_reply, additional_system_messages, service_after_message = await get_model_answer(openai_client, update, context, [system_message] + history)
+        bot_reply, additional_system_messages, service_after_message = await get_model_answer(openai_client, update, context, messages, stream_reply=stream_reply)
         
-        # Добавляем дополнительную информацию в историю
+        # Новые сообщения хода: вопрос пользователя (последний в урезанной истории) и дополнительная информация
+        turn = [history[-1]]
         if additional_system_messages is not None:
             for message in additional_system_messages:
-                history.append(message)
+                turn.append(message)
                 logger.info(f"В историю добавлена новая системная информация: {message}")
+        # Изображение отправляется модели только в текущем ходе, в истории остается ссылка на него
+        compact_image_messages(turn, bot_reply)
+
         # Добавляем ответ бота в историю
         if bot_reply is not None:
-            history.append({"role": "assistant", "content": bot_reply})
+            turn.append({"role": "assistant", "content": bot_reply})
         
-        # Обновляем историю пользователя
-        await user_histories.set(update.effective_user.id, history)
+        # Ход добавляется к сохраненной истории атомарно: пока шел запрос к модели, историю
+        # могли изменить (геолокация, заметки, /reset), и эти изменения не должны потеряться
+        max_tokens = await get_history_token_limit(user_id)
+        history = await user_histories.update(user_id, lambda stored: trim_history(stored + turn, max_tokens), [])
         logger.info(f"История пользователя обновлена: {history}")
         
         return bot_reply
@@ -123,29 +94,20 @@ async def get_bot_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, user
         return "Извините, произошла ошибка при обработке вашего запроса."
 
 async def get_history(user_id, user_message):
-    history = await user_histories.get(user_id, [])
+    """История для запроса к модели. Сохраненная история не изменяется - ход записывается в get_bot_reply."""
+    history = list(await user_histories.get(user_id, []))
     # Добавляем новое сообщение пользователя в историю
-    history.append({"role": "user", "content": user_message})
-
-    # Разделяем историю на системные и прочие сообщения
-    system_messages = [m for m in history if m["role"] == "system"]
-    other_messages = [m for m in history if m["role"] != "system"]
-
-    # Вычисляем, сколько сообщений можно оставить из не-системных, 
-    # чтобы общая длина не превысила max_history_length
-    allowed_other_count = max_history_length - len(system_messages)
-    if allowed_other_count < 0:
-        # Если системных сообщений даже больше, чем max_history_length,
-        # то их не трогаем, но это означает, что ограничение фактически недостижимо
-        allowed_other_count = 0
+    if isinstance(user_message, dict):
+        history.append(user_message)
+    else:
+        history.append({"role": "user", "content": user_message})
 
-    # Если нужно урезать список прочих сообщений, оставляем последние allowed_other_count
-    if len(other_messages) > allowed_other_count:
-        other_messages = other_messages[-allowed_other_count:]
+    # Урезаем историю так, чтобы запрос вместе с системными сообщениями уложился в лимит модели
+    return trim_history(history, await get_history_token_limit(user_id))
 
-    # Снова объединяем историю, сохранив системные сообщения на месте
-    history = system_messages + other_messages
-    return history
+async def get_history_token_limit(user_id) -> int:
+    model_name = await get_user_model(user_id)
+    return get_prompt_token_limit(model_name) - get_fixed_prompt_tokens()
 
 async def send_big_text(update: Update, text_to_send):
     if len(text_to_send) > 4096:
@@ -154,11 +116,14 @@ async def send_big_text(update: Update, text_to_send):
             await reply_text(update,msg)
     else:
         await reply_text(update,text_to_send)
+    await send_history_reminder(update)
+
+async def send_history_reminder(update: Update):
     history = await user_histories.get(update.effective_user.id, [])
     if len(history)==8 or len(history)==14:
         await reply_service_text(update, 
 f"""Не забывайте сбрасывать контекст (историю) беседы с помощью команды /reset или командой из меню. 
-Бот в своих ответах учитывает предыдущие {max_history_length} сообщений.
+Бот в своих ответах учитывает последние сообщения в пределах {get_prompt_token_limit(await get_user_model(update.effective_user.id))} токенов.
 Это было {len(history)} сообщение. 
 """
 )
@@ -173,10 +138,23 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return await handle_message_inner(update, context, user_message)
 
 async def handle_message_inner(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message):
-    bot_reply = await get_bot_reply(update, context, user_message)
+    if not is_stream_replies_enabled():
+        bot_reply = await get_bot_reply(update, context, user_message)
+        if bot_reply is None or len(bot_reply) == 0:
+            return
+        await send_big_text(update, bot_reply)
+        await set_session_info(update.effective_user)
+        return
+
+    # Ответ показывается по мере генерации в сообщении-заглушке
+    stream_reply = StreamingReply(update)
+    await stream_reply.start()
+    bot_reply = await get_bot_reply(update, context, user_message, stream_reply)
     if bot_reply is None or len(bot_reply) == 0:
+        await stream_reply.cancel()
         return
-    await send_big_text(update, bot_reply)
+    await stream_reply.finish(bot_reply)
+    await send_history_reminder(update)
     await set_session_info(update.effective_user)
 
 async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -192,31 +170,34 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
         await not_authorized_message(update, user)
         return
     
-    # Получение файла голосового сообщения
-    file = await context.bot.get_file(voice.file_id)
-
-    # Использование временного файла для хранения голосового сообщения
-    with tempfile.NamedTemporaryFile(delete=True, suffix=".ogg") as temp_file:
-        await file.download_to_drive(temp_file.name)  # Загрузка файла
-        logger.info(f"Временный файл загружен: {temp_file.name}")
-
-        try:
-            # Распознавание речи с использованием OpenAI
-            recognized_text=transcribe_audio(openai_client,temp_file.name)
-            
-            if recognized_text=="":
-                 await reply_service_text(update,"Произошла ошибка при распознавании вашего сообщения.")
-                 return
-            await send_big_text(update, f"Распознаный текст: \n {recognized_text}")
-            await handle_message_inner(update, context, recognized_text) 
-            logger.info(f"Распознанный текст от пользователя {user.id}: {recognized_text}")
-        except Exception as e:
-            logger.error(f"Ошибка при распознавании текста через OpenAI: {e}")
-            await reply_service_text(update,"Произошла ошибка при распознавании вашего сообщения.")
+    timer = StageTimer()
+    try:
+        # Голосовое сообщение загружается в память, без временных файлов
+        file = await context.bot.get_file(voice.file_id)
+        audio = bytes(await file.download_as_bytearray())
+        timer.mark("загрузка")
+        logger.info(f"Голосовое сообщение загружено: {len(audio)} байт")
+
+        # Распознавание речи с использованием OpenAI
+        recognized_text=await transcribe_audio(openai_client, audio)
+        timer.mark("распознавание")
+
+        if not recognized_text:
+             await reply_service_text(update,"Произошла ошибка при распознавании вашего сообщения.")
+             return
+        logger.info(f"Распознанный текст от пользователя {user.id}: {recognized_text}")
+        await send_big_text(update, f"Распознаный текст: \n {recognized_text}")
+        await handle_message_inner(update, context, recognized_text)
+        timer.mark("ответ")
+    except Exception as e:
+        logger.error(f"Ошибка при распознавании текста через OpenAI: {e}")
+        await reply_service_text(update,"Произошла ошибка при распознавании вашего сообщения.")
+    finally:
+        logger.info(f"Голосовое сообщение пользователя {user.id}: {timer}")
 
 async def not_authorized_message(update, user):
     await reply_service_text(update,f"Извините, у вас нет доступа к этому боту. Пользователь {user}")
-    logger.error(f"Нет доступа: {user}. Допустимые пользователи: {administrators_ids}")
+    logger.error(f"Нет доступа: {user}. Допустимые пользователи: {get_admins()}")
 
 async def set_telegram_webhook(application):
     await application.bot.set_webhook(WEBHOOK_URL)
@@ -225,13 +206,11 @@ async def set_telegram_webhook(application):
 async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         if update.message.location:
-            history = await user_histories.get(update.effective_user.id, [])
             latitude = update.message.location.latitude
             longitude = update.message.location.longitude
             address = await get_address(latitude,longitude)
             location_message = f"Твои координаты: Широта: {latitude} Долгота: {longitude}\nАдрес: {address}"
-            history.append({"role": "system", "content": location_message})
-            await user_histories.set(update.effective_user.id, history)
+            await user_histories.update(update.effective_user.id, lambda history: history + [{"role": "system", "content": location_message}], [])
             await reply_service_text(update,location_message)
             await handle_message_inner(update, context, "Геолокация отправлена. Внимательно проанализируйте историю и постарайтесь ответить на ранее заданный вопрос или вызовите следующую функцию, необходимую для ответа.")
     except Exception as e:
@@ -239,47 +218,96 @@ async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        # Получаем файл изображения
+        # Получаем файл изображения в память и уменьшаем до разрешения, используемого моделью
         photo_file = await update.message.photo[-1].get_file()
-        photo_path = f'user_{update.effective_user.id}_image.jpg'
-        await photo_file.download_to_drive(photo_path)
-
-        # Определяем MIME-тип
-        img_type, _ = mimetypes.guess_type(photo_path)
-        if img_type is None:
-            img_type = "application/octet-stream"  # На случай, если тип определить не удалось
-
-        # Кодируем изображение в base64 для OpenAI
-        with open(photo_path, 'rb') as image_file:
-            image_content = image_file.read()
-            # Преобразование в Base64
-            img_b64_bytes = base64.b64encode(image_content)
-            # Преобразование в строку
-            img_b64_str = img_b64_bytes.decode("utf-8")
-            await set_user_image(update.effective_user.id, {"image_type": img_type, "image":img_b64_str})
+        image_bytes = bytes(await photo_file.download_as_bytearray())
+        image = await ingest_image(image_bytes)
+        await set_user_image(update.effective_user.id, image)
 
         await reply_service_text(update,"Изображение загружено, задайте вопрос по нему")
     except Exception as e:
         await reply_service_text(update,"Ошибка при загрузке изображения")
         logger.error(f"Ошибка в обработчике изображений: {e}")
 
+# Загрузка заметок из файла JSON или CSV
+async def handle_notes_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if not await in_user_list(user):
+        await not_authorized_message(update, user)
+        return
+    document = update.message.document
+    try:
+        # Размер проверяется по метаданным документа, чтобы не скачивать слишком большой файл
+        check_notes_file(document.file_name or "", document.file_size)
+        file = await context.bot.get_file(document.file_id)
+        notes = parse_notes_file(document.file_name or "", bytes(await file.download_as_bytearray()))
+    except (ValueError, UnicodeDecodeError) as e:
+        await reply_service_text(update, f"Не удалось прочитать файл заметок: {e}")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке файла заметок: {e}")
+        await reply_service_text(update, "Ошибка при загрузке файла заметок.")
+        return
+
+    report = await import_notes(user.id, notes)
+    answer = f"Заметок создано: {len(report['created'])}, обновлено: {len(report['updated'])}, ошибок: {len(report['failed'])}."
+    for failed in report["failed"][:10]:
+        answer += f"\nЗаметка {failed['NoteId']}: {failed['error']}"
+    await reply_service_text(update, answer)
+
 async def show_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if await in_user_list(user):
 
-        documents = get_all_user_notes(update.effective_user.id)
-        if len(documents) == 0:
+        # /show_notes <курсор> продолжает список с места, где остановилась предыдущая страница
+        cursor = context.args[0] if context.args else None
+        try:
+            page = await get_notes_page(update.effective_user.id, cursor)
+        except ValueError as e:
+            await reply_service_text(update,str(e))
+            return
+        except Exception as e:
+            logger.error(f"Ошибка при получении заметок: {e}")
+            await reply_service_text(update,"Ошибка при получении заметок.")
+            return
+        if page.shown == 0:
             await reply_service_text(update,"Заметки не найдены.")
             return
-        answer, system_message_body = get_notes_text(documents)
-        history = await user_histories.get(update.effective_user.id, [])
-        history.append({"role": "system", "content": system_message_body})
-        await user_histories.set(update.effective_user.id, history)
-        
+        await user_histories.update(update.effective_user.id, lambda history: history + [{"role": "system", "content": page.system_message_body}], [])
+
+        answer = page.answer
+        if page.cursor is not None:
+            answer += f"\nВсего заметок: {page.total}. Продолжение списка: /show_notes {page.cursor}"
         await reply_service_text(update,answer)
     else:
         await reply_service_text(update,"У вас нет прав на эту команду.")
 
+async def init_openai():
+    global openai_client
+    openai_client = create_openai_client(opena_ai_api_key)
+    # Векторы заметок запрашиваются через тот же пул соединений
+    use_openai_client(openai_client)
+    try:
+        # Прогрев соединения, чтобы первый запрос пользователя не ждал TLS-рукопожатия
+        await openai_client.models.retrieve(OpenAI_Models.DEFAULT_MODEL.value)
+    except Exception as e:
+        logger.error(f"OpenAI недоступен при старте: {e}")
+
+async def init_storage():
+    await init_db()
+    await user_histories.open()
+
+async def startup(application):
+    """Параллельная инициализация MySQL, Elasticsearch, OpenAI и Telegram с замером времени этапов."""
+    timer = StageTimer()
+    await asyncio.gather(
+        timer.measure("MySQL", init_storage()),
+        timer.measure("Elasticsearch", init_elastic()),
+        timer.measure("OpenAI", init_openai()),
+        timer.measure("Telegram", application.initialize()),
+    )
+    logger.info(f"Startup: {timer}. Всего {timer.total():.2f} сек.")
+
 async def main():
     set_bot_version(version)
     # Инициализация приложения
@@ -290,6 +318,7 @@ async def main():
     application.add_handler(MessageHandler(filters.VOICE, handle_voice_message))
     application.add_handler(MessageHandler(filters.LOCATION, location_handler))
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    application.add_handler(MessageHandler(filters.Document.FileExtension("json") | filters.Document.FileExtension("csv"), handle_notes_file))
     # Добавление обработчиков команд
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("list", list_users))
@@ -304,20 +333,60 @@ async def main():
     
     
 
-    # Инициализация и запуск приложения
-    await application.initialize()
+    # Инициализация зависимостей и запуск приложения
+    await startup(application)
     await application.start()
 
+    # Журнал входящих обновлений: защита от потерь при рестарте и от повторных доставок
+    spool = create_spool_from_os()
+
+    async def process_spooled_update(update):
+        try:
+            await application.process_update(update)
+        except Exception:
+            spool.mark_done(update.update_id)
+            raise
+        # При отмене (остановка бота) обновление остается в журнале и будет обработано после рестарта
+        spool.mark_done(update.update_id)
+
+    # Очередь обновлений: порядок внутри чата и ограничение параллелизма
+    dispatcher = create_dispatcher_from_os(process_spooled_update, on_drop=lambda update: spool.mark_done(update.update_id))
+
+    # Повторная обработка обновлений, не обработанных до перезапуска
+    pending_updates = spool.get_pending()
+    if pending_updates:
+        logger.info(f"Повторная обработка {len(pending_updates)} обновлений из журнала")
+    for _, payload in pending_updates:
+        update = Update.de_json(payload, application.bot)
+        while not dispatcher.submit(update):
+            await asyncio.sleep(0.1)
+
     # Настройка маршрута вебхука
     async def telegram_webhook_handler(request):
-        update = await request.json()
-        update = Update.de_json(update, application.bot)
-        asyncio.create_task(application.process_update(update))
+        payload = await request.text()
+        data = json.loads(payload)
+        update_id = data.get("update_id")
+        if not spool.append(update_id, payload):
+            logger.info(f"Повторная доставка обновления {update_id} пропущена")
+            return web.Response(text="OK")
+        update = Update.de_json(data, application.bot)
+        if not dispatcher.submit(update):
+            # Очередь переполнена - Telegram повторит доставку позже
+            spool.discard(update_id)
+            return web.Response(status=503, text="Busy")
         return web.Response(text="OK")
 
+    # Статистика очередей для подбора параметров под нагрузкой
+    async def stats_handler(request):
+        return web.json_response({"dispatcher": dispatcher.get_stats(), "state": get_state_stats(), "prompt_cache": get_prompt_cache_stats(),
+                                  "weather_cache": weather_cache.get_stats(),
+                                  "geocode_cache": get_geocode_cache().get_stats(),
+                                  "embedding_cache": get_embedding_cache().get_stats()})
+
     # Создание веб-приложения aiohttp
     app = web.Application()
     app.router.add_post('/telegram-webhook', telegram_webhook_handler)
+    app.router.add_get('/stats', stats_handler)
 
     # Запуск вебхука
     runner = web.AppRunner(app)
@@ -328,14 +397,33 @@ async def main():
     # Установка вебхука в Telegram
     await set_telegram_webhook(application)
 
+    # Отложенная запись истории бесед
+    history_flusher = asyncio.create_task(user_histories.run_flusher())
+    # Отложенная запись последних сессий
+    session_activity = get_session_activity()
+    session_flusher = asyncio.create_task(session_activity.run_flusher())
+    # Периодическое обновление индекса доступа из MySQL
+    access_refresher = asyncio.create_task(run_user_ids_refresher(float(os.getenv('ACCESS_REFRESH_INTERVAL', '300'))))
+
     # Запуск бота
     logger.info(f"Bot v{version} is running. DefaultModel - {OpenAI_Models.DEFAULT_MODEL.value}")
     try:
         await asyncio.Event().wait()
     finally:
         # Корректная остановка приложения
+        await dispatcher.shutdown()
+        access_refresher.cancel()
+        history_flusher.cancel()
+        await user_histories.flush()
+        session_flusher.cancel()
+        await session_activity.flush()
+        spool.close()
         await application.stop()
         await application.shutdown()
+        await openai_client.close()
+        await close_session()
+        await close_elastic()
+        await close_embeddings()
         logger.info("Bot has stopped.")
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+import csv
+import io
+import json
+import os
+
+# Ограничения на загружаемый файл заметок
+notes_import_max_bytes = int(os.getenv('NOTES_IMPORT_MAX_BYTES', str(5 * 1024 * 1024)))
+notes_import_max_notes = int(os.getenv('NOTES_IMPORT_MAX_NOTES', '2000'))
+
+supported_extensions = ("json", "csv")
+
+
+def get_field(record: dict, name: str):
+    """Значение поля без учета регистра имени (Title, title, TITLE)."""
+    for key, value in record.items():
+        if key is not None and key.strip().lower() == name.lower():
+            return value
+    return None
+
+
+def parse_tags(tags) -> list[str]:
+    if tags is None:
+        return []
+    if isinstance(tags, list):
+        return [str(tag).strip() for tag in tags if str(tag).strip()]
+    separator = ";" if ";" in str(tags) else ","
+    return [tag.strip() for tag in str(tags).split(separator) if tag.strip()]
+
+
+def normalize_note(record: dict, number: int) -> dict:
+    if not isinstance(record, dict):
+        raise ValueError(f"Заметка {number}: ожидается объект с полями Title, Body, Tags.")
+    title = get_field(record, "Title")
+    if title is None or not str(title).strip():
+        raise ValueError(f"Заметка {number}: не указан заголовок (Title).")
+    note_id = get_field(record, "NoteId")
+    return {
+        "NoteId": str(note_id).strip() if note_id not in (None, "") else None,
+        "Title": str(title).strip(),
+        "Body": str(get_field(record, "Body") or ""),
+        "Tags": parse_tags(get_field(record, "Tags")),
+        "CreatedDate": get_field(record, "CreatedDate") or None,
+    }
+
+
+def get_extension(file_name: str) -> str:
+    return file_name.rsplit(".", 1)[-1].lower() if "." in file_name else ""
+
+
+def check_notes_file(file_name: str, file_size: int = None):
+    """Проверяет имя и размер файла заметок. Вызывается по метаданным документа до скачивания файла."""
+    if get_extension(file_name) not in supported_extensions:
+        raise ValueError("Поддерживаются только файлы .json и .csv.")
+    if file_size is not None and file_size > notes_import_max_bytes:
+        raise ValueError(f"Файл слишком большой, максимум {notes_import_max_bytes // 1024} КБ.")
+
+
+def parse_notes_file(file_name: str, data: bytes) -> list[dict]:
+    """Разбирает файл заметок JSON (список объектов или {"notes": [...]}) или CSV с заголовком.
+
+    Поля: Title (обязательно), Body, Tags (список или строка через ";" или ","), NoteId, CreatedDate.
+    """
+    check_notes_file(file_name, len(data))
+    extension = get_extension(file_name)
+    text = data.decode("utf-8-sig")
+
+    if extension == "json":
+        records = json.loads(text)
+        if isinstance(records, dict):
+            records = records.get("notes")
+        if not isinstance(records, list):
+            raise ValueError("JSON должен содержать список заметок или объект с полем notes.")
+    else:
+        records = list(csv.DictReader(io.StringIO(text)))
+
+    if len(records) > notes_import_max_notes:
+        raise ValueError(f"Слишком много заметок, максимум {notes_import_max_notes} за раз.")
+    return [normalize_note(record, number) for number, record in enumerate(records, start=1)]
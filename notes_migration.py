@@ -0,0 +1,327 @@
+"""Миграция индекса заметок на новую версию схемы без остановки бота.
+
+    python notes_migration.py status
+    python notes_migration.py migrate [--version N]
+    python notes_migration.py rollback
+    python notes_migration.py backfill
+
+Заметки хранятся в версионированных индексах user_notes_index_vN, бот работает через
+псевдоним user_notes_index. migrate создает индекс новой версии, переиндексирует в него
+заметки, дописывает изменения, сделанные во время переиндексации (по полю UpdatedAt),
+и атомарно переключает псевдоним. Перед переключением старый индекс закрывается для записи,
+в новый дописываются последние изменения и переносятся удаления. Пока идет эта короткая
+дозапись, бот сообщает пользователю, что заметку сохранить не удалось.
+Предыдущий индекс сохраняется, rollback переключает псевдоним обратно так же.
+Исходный индекс без версии сначала копируется в user_notes_index_v1.
+При переходе на схему с векторами (версия 3) заметкам добавляются векторы; backfill
+добавляет их заметкам активного индекса, у которых вектора нет, и заполняет поле NoteId.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+
+from elastic import (bulk_chunk_size, close_elastic, get_connection, get_elastic_datetime_now_utc, get_index_schema_version,
+                     get_notes_index_body, get_versioned_index_name, latest_schema_version, notes_index_name,
+                     put_added_fields)
+from embeddings import close_embeddings, get_embeddings, get_note_embedding_text, is_semantic_search_enabled, is_zero_vector
+
+reindex_timeout = float(os.getenv('ELASTIC_REINDEX_TIMEOUT', '3600'))
+
+
+async def get_alias_targets() -> list[str]:
+    es = get_connection()
+    if not await es.indices.exists_alias(name=notes_index_name):
+        return []
+    return list(await es.indices.get_alias(name=notes_index_name))
+
+
+async def get_versioned_indices() -> dict[int, str]:
+    """Индексы заметок с версией в имени: {версия: имя индекса}."""
+    response = await get_connection().indices.get(index=f"{notes_index_name}_v*", ignore_unavailable=True)
+    indices = {}
+    for index_name in response:
+        match = re.fullmatch(rf"{re.escape(notes_index_name)}_v(\d+)", index_name)
+        if match:
+            indices[int(match.group(1))] = index_name
+    return indices
+
+
+async def get_migrated_at(index_name: str) -> str:
+    response = await get_connection().indices.get_mapping(index=index_name)
+    return response[index_name]["mappings"].get("_meta", {}).get("migrated_at")
+
+
+async def create_versioned_index(version: int, migrated_at: str) -> str:
+    index_name = get_versioned_index_name(version)
+    index_body = get_notes_index_body(version)
+    index_body["mappings"]["_meta"]["migrated_at"] = migrated_at
+    await get_connection().indices.create(index=index_name, body=index_body)
+    print(f"Создан индекс {index_name}.")
+    return index_name
+
+
+async def reindex(source: str, dest: str, dest_version: int, since: str = None):
+    """Копирует заметки из source в dest. since - только заметки, измененные начиная с этого времени."""
+    body = {"source": {"index": source}, "dest": {"index": dest}, "conflicts": "proceed"}
+    if since is not None:
+        body["source"]["query"] = {"range": {"UpdatedAt": {"gte": since}}}
+    script = ["ctx._source.NoteId = ctx._id;"]
+    if dest_version >= 2:
+        # Документы нового индекса маршрутизируются по пользователю
+        script.append("ctx._routing = String.valueOf(ctx._source.UserId);")
+    else:
+        body["dest"]["routing"] = "discard"
+    if dest_version < 3:
+        # В схеме без векторов поле Embedding было бы добавлено динамическим маппингом
+        script.append("ctx._source.remove('Embedding');")
+    body["script"] = {"lang": "painless", "source": " ".join(script)}
+    # Индекс предыдущей версии при откате мог быть создан до появления полей notes_added_fields
+    await put_added_fields(dest)
+    response = await get_connection().reindex(body=body, refresh=True, wait_for_completion=True,
+                                               request_timeout=reindex_timeout)
+    if response.get("failures"):
+        raise RuntimeError(f"Ошибки переиндексации {source} -> {dest}: {response['failures'][:5]}")
+    print(f"Переиндексация {source} -> {dest}: создано {response['created']}, обновлено {response['updated']}.")
+
+
+async def get_document_routing(index_name: str) -> dict:
+    """Идентификаторы всех документов индекса с их маршрутизацией: {идентификатор: routing}."""
+    es = get_connection()
+    search_query = {"query": {"match_all": {}}, "_source": False, "sort": ["_doc"], "size": 1000}
+    response = await es.search(index=index_name, body=search_query, scroll="5m", request_timeout=reindex_timeout)
+    documents = {}
+    try:
+        while response["hits"]["hits"]:
+            for hit in response["hits"]["hits"]:
+                documents[hit["_id"]] = hit.get("_routing")
+            response = await es.scroll(scroll_id=response["_scroll_id"], scroll="5m", request_timeout=reindex_timeout)
+    finally:
+        await es.clear_scroll(scroll_id=response["_scroll_id"], ignore=404)
+    return documents
+
+
+async def sync_deletes(source: str, dest: str):
+    """Удаляет из dest заметки, которых больше нет в source."""
+    source_ids = await get_document_routing(source)
+    stale = [(note_id, routing) for note_id, routing in (await get_document_routing(dest)).items() if note_id not in source_ids]
+    es = get_connection()
+    for start in range(0, len(stale), bulk_chunk_size):
+        body = []
+        for note_id, routing in stale[start:start + bulk_chunk_size]:
+            metadata = {"_id": note_id}
+            if routing is not None:
+                metadata["routing"] = routing
+            body.append({"delete": metadata})
+        await es.bulk(body=body, index=dest, request_timeout=reindex_timeout)
+    await es.indices.refresh(index=dest)
+    print(f"Удаления перенесены {source} -> {dest}: {len(stale)}.")
+
+
+async def set_write_block(index_name: str, blocked: bool):
+    await get_connection().indices.put_settings(index=index_name, body={"index": {"blocks": {"write": blocked}}})
+
+
+async def switch_alias(source: str, copies: list[tuple[str, int]], since: str, actions: list[dict]):
+    """Переключает псевдоним с source, не теряя записей, сделанных в source до переключения.
+
+    copies - индексы (имя, версия схемы), в которые дописываются изменения из source.
+    На время дозаписи source закрыт для записи, после переключения он остается закрытым.
+    """
+    await set_write_block(source, True)
+    switched = False
+    try:
+        for index_name, version in copies:
+            await reindex(source, index_name, version, since=since)
+            await sync_deletes(source, index_name)
+            await backfill_embeddings(index_name)
+        await get_connection().indices.update_aliases(body={"actions": actions})
+        switched = True
+    finally:
+        if not switched:
+            await set_write_block(source, False)
+            print(f"Переключение не выполнено, запись в {source} снова разрешена.")
+
+
+async def backfill_note_ids(index_name: str):
+    """Заполняет поле NoteId (копию _id, по которой сортируется постраничная выдача) у заметок, где его нет."""
+    await put_added_fields(index_name)
+    response = await get_connection().update_by_query(index=index_name, body={
+        "query": {"bool": {"must_not": {"exists": {"field": "NoteId"}}}},
+        "script": {"lang": "painless", "source": "ctx._source.NoteId = ctx._id;"},
+    }, conflicts="proceed", refresh=True, wait_for_completion=True, request_timeout=reindex_timeout)
+    print(f"NoteId заполнен в {index_name}: {response['updated']}.")
+
+
+async def backfill_embeddings(index_name: str):
+    """Добавляет векторы заметкам индекса, у которых их нет. Уже посчитанные векторы берутся из локального кэша."""
+    if await get_index_schema_version(index_name) < 3:
+        return
+    if not is_semantic_search_enabled():
+        print("Провайдер векторов отключен (EMBEDDING_PROVIDER=none), векторы не добавлены.")
+        return
+    es = get_connection()
+    search_query = {
+        "query": {"bool": {"must_not": {"exists": {"field": "Embedding"}}}},
+        "_source": ["Title", "Body", "Tags"],
+        "size": 200,
+    }
+    response = await es.search(index=index_name, body=search_query, scroll="5m", request_timeout=reindex_timeout)
+    updated = 0
+    failed = 0
+    try:
+        while response["hits"]["hits"]:
+            hits = response["hits"]["hits"]
+            vectors = await get_embeddings([get_note_embedding_text(hit["_source"].get("Title", ""), hit["_source"].get("Body", ""),
+                                                                    hit["_source"].get("Tags")) for hit in hits])
+            body = []
+            for hit, vector in zip(hits, vectors):
+                # Заметке без слов вектор не нужен: по косинусу ее сравнить нельзя
+                if is_zero_vector(vector):
+                    continue
+                metadata = {"_id": hit["_id"]}
+                if hit.get("_routing") is not None:
+                    metadata["routing"] = hit["_routing"]
+                body += [{"update": metadata}, {"doc": {"Embedding": vector}}]
+            if body:
+                result = await es.bulk(body=body, index=index_name, request_timeout=reindex_timeout)
+                errors = sum(1 for item in result["items"] if "error" in item["update"])
+                failed += errors
+                updated += len(result["items"]) - errors
+            response = await es.scroll(scroll_id=response["_scroll_id"], scroll="5m", request_timeout=reindex_timeout)
+    finally:
+        await es.clear_scroll(scroll_id=response["_scroll_id"], ignore=404)
+    await es.indices.refresh(index=index_name)
+    print(f"Векторы добавлены в {index_name}: {updated}, ошибок {failed}.")
+
+
+async def migrate(target_version: int):
+    es = get_connection()
+    started_at = get_elastic_datetime_now_utc()
+    targets = await get_alias_targets()
+    legacy = not targets and await es.indices.exists(index=notes_index_name)
+    if not targets and not legacy:
+        print(f"Индекс {notes_index_name} не найден. Создайте его через elastic.create_indexes().")
+        return
+
+    if legacy:
+        # Копия исходного индекса нужна для отката: сам он будет удален при переключении псевдонима
+        source = notes_index_name
+        source_version = 1
+        legacy_copy = get_versioned_index_name(1)
+        if not await es.indices.exists(index=legacy_copy):
+            await create_versioned_index(1, started_at)
+        await reindex(source, legacy_copy, 1)
+        copies = [(legacy_copy, 1)]
+    else:
+        source = targets[0]
+        source_version = await get_index_schema_version(source)
+        copies = []
+
+    if source_version >= target_version:
+        print(f"Псевдоним {notes_index_name} уже указывает на схему версии {source_version}.")
+        if legacy:
+            await switch_alias(source, copies, started_at, [
+                {"add": {"index": legacy_copy, "alias": notes_index_name}},
+                {"remove_index": {"index": notes_index_name}},
+            ])
+            print(f"Исходный индекс заменен псевдонимом на {legacy_copy}.")
+        return
+
+    dest = get_versioned_index_name(target_version)
+    if await es.indices.exists(index=dest):
+        print(f"Индекс {dest} уже существует. Удалите его или выполните rollback.")
+        return
+    await create_versioned_index(target_version, started_at)
+    await reindex(source, dest, target_version)
+    # Дописываем заметки, добавленные и измененные во время переиндексации, пока запись еще открыта
+    caught_up_at = get_elastic_datetime_now_utc()
+    await reindex(source, dest, target_version, since=started_at)
+    await backfill_embeddings(dest)
+    copies.append((dest, target_version))
+
+    actions = [{"add": {"index": dest, "alias": notes_index_name}}]
+    if legacy:
+        actions.append({"remove_index": {"index": notes_index_name}})
+    else:
+        actions.insert(0, {"remove": {"index": source, "alias": notes_index_name}})
+    # Копия исходного индекса без версии дописывается с начала миграции, новый индекс - с последней дозаписи
+    await switch_alias(source, copies, started_at if legacy else caught_up_at, actions)
+    print(f"Псевдоним {notes_index_name} переключен на {dest} (схема версии {target_version}).")
+
+
+async def rollback():
+    targets = await get_alias_targets()
+    if not targets:
+        print(f"Псевдоним {notes_index_name} не найден, откатывать нечего.")
+        return
+    current = targets[0]
+    current_version = await get_index_schema_version(current)
+    previous_versions = [version for version in await get_versioned_indices() if version < current_version]
+    if not previous_versions:
+        print(f"Нет индекса предыдущей версии для {current}.")
+        return
+    previous_version = max(previous_versions)
+    previous = get_versioned_index_name(previous_version)
+
+    # Переносим заметки, измененные и удаленные после миграции, чтобы откат их не потерял.
+    # Предыдущий индекс был закрыт для записи при переключении на текущий
+    migrated_at = await get_migrated_at(current)
+    await set_write_block(previous, False)
+    await switch_alias(current, [(previous, previous_version)], migrated_at, [
+        {"remove": {"index": current, "alias": notes_index_name}},
+        {"add": {"index": previous, "alias": notes_index_name}},
+    ])
+    print(f"Псевдоним {notes_index_name} переключен на {previous} (схема версии {previous_version}). "
+          f"Индекс {current} сохранен.")
+
+
+async def status():
+    es = get_connection()
+    targets = await get_alias_targets()
+    if targets:
+        print(f"Псевдоним {notes_index_name} -> {', '.join(targets)}")
+    elif await es.indices.exists(index=notes_index_name):
+        print(f"{notes_index_name} - индекс без версии (схема версии 1), требуется migrate.")
+    else:
+        print(f"Индекс {notes_index_name} не найден.")
+    for version, index_name in sorted((await get_versioned_indices()).items()):
+        count = (await es.count(index=index_name))["count"]
+        active = " (активный)" if index_name in targets else ""
+        print(f"{index_name}: схема версии {await get_index_schema_version(index_name)}, заметок {count}{active}")
+    print(f"Последняя версия схемы: {latest_schema_version}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Миграция индекса заметок Elasticsearch")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate", help="перейти на новую версию схемы")
+    migrate_parser.add_argument("--version", type=int, default=latest_schema_version)
+    commands.add_parser("rollback", help="вернуть псевдоним на предыдущую версию")
+    commands.add_parser("status", help="показать состояние индексов")
+    commands.add_parser("backfill", help="добавить NoteId и векторы заметкам активного индекса")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "migrate":
+            await migrate(args.version)
+        elif args.command == "rollback":
+            await rollback()
+        elif args.command == "backfill":
+            targets = await get_alias_targets()
+            if not targets:
+                print(f"Псевдоним {notes_index_name} не найден.")
+                return
+            await backfill_note_ids(targets[0])
+            await backfill_embeddings(targets[0])
+        else:
+            await status()
+    finally:
+        await close_elastic()
+        await close_embeddings()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+import base64
+import json
+import os
+
+from elastic import get_user_notes_page
+from token_budget import count_text_tokens
+
+# Сколько заметок запрашивать за раз и сколько токенов может занимать одна страница в промпте
+notes_page_size = int(os.getenv('NOTES_PAGE_SIZE', '50'))
+notes_page_tokens = int(os.getenv('NOTES_PAGE_TOKENS', '1500'))
+# Длина фрагмента текста заметки в списке
+notes_snippet_length = int(os.getenv('NOTES_SNIPPET_LENGTH', '200'))
+
+
+class NotesPage:
+    """Страница списка заметок: текст для пользователя, текст для модели и курсор продолжения."""
+
+    def __init__(self, answer: str, system_message_body: str, shown: int, total: int, cursor: str = None):
+        self.answer = answer
+        self.system_message_body = system_message_body
+        self.shown = shown
+        self.total = total
+        self.cursor = cursor
+
+
+def encode_cursor(search_after: list) -> str:
+    data = json.dumps(search_after, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        search_after = json.loads(data)
+    except ValueError:
+        raise ValueError("Некорректный курсор продолжения списка заметок.")
+    if not isinstance(search_after, list):
+        raise ValueError("Некорректный курсор продолжения списка заметок.")
+    return search_after
+
+
+def get_snippet(text: str) -> str:
+    text = " ".join(str(text).split())
+    if len(text) <= notes_snippet_length:
+        return text
+    return text[:notes_snippet_length].rstrip() + "…"
+
+
+async def get_notes_page(user_id: int, cursor: str = None, max_tokens: int = notes_page_tokens) -> NotesPage:
+    """Страница заметок пользователя: заголовки и фрагменты текста, не больше max_tokens токенов.
+
+    Если заметки не поместились, возвращается курсор, с которого продолжается список.
+    """
+    search_after = decode_cursor(cursor) if cursor else None
+    documents, next_search_after, total = await get_user_notes_page(user_id, notes_page_size, search_after)
+
+    answer = ""
+    system_message_body = ""
+    tokens = 0
+    shown = 0
+    for doc in documents:
+        snippet = get_snippet(doc.get('Body', ''))
+        note_text = (f"#Note ID: {doc['NoteId']}, Title: {doc['Title']}\n ##Snippet:\n{snippet}\n"
+                     f" ##Tags:\n{doc.get('Tags')}\n##Created:\n{doc.get('CreatedDate')}\n")
+        note_tokens = count_text_tokens(note_text)
+        # Первая заметка показывается всегда, чтобы список продвигался
+        if shown > 0 and tokens + note_tokens > max_tokens:
+            next_search_after = documents[shown - 1]['Sort']
+            break
+        tokens += note_tokens
+        shown += 1
+        answer += f"ID {doc['NoteId']} - {doc['Title']}: {snippet}\n"
+        system_message_body += note_text
+
+    return NotesPage(answer, system_message_body, shown, total,
+                     encode_cursor(next_search_after) if next_search_after is not None else None)
@@ -1,11 +1,13 @@
 import asyncio
 from functools import partial
-import json
 import logging
 import os
 from typing import Tuple
+import httpx
 import openai
-import requests
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_message_tool_call import Function
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
@@ -15,13 +17,46 @@ from telegram.ext import (
     filters,
 )
 from common_types import dict_to_markdown
-from elastic import add_note, get_all_user_notes, get_notes_by_query, remove_notes
+from elastic import add_note, get_notes_by_query, remove_notes
+from notes_pages import get_notes_page
 from state_and_commands import OpenAI_Models, add_location_button, get_OpenAI_Models, get_notes_text, get_user_model, get_voice_recognition_model, reply_service_text, set_user_model
+from prompt import record_usage
+from token_budget import prepare_messages
+from tools import ToolContext, ToolResult, execute_tool_call, get_tool_schemas, register_tool
 from weather import  get_weather_description2, get_weekly_forecast
 from yandex_maps import get_location_by_address
 
 
-MAXIMUM_RECURSION_ANSWER_DEPTH = 10
+# Максимальное количество обращений к модели за один ответ (вызовы инструментов и итоговый ответ)
+MAXIMUM_TOOL_ROUNDS = 10
+
+# Ограничения одновременных запросов к OpenAI по типам запросов, чтобы медленные
+# генерации изображений или распознавание речи не занимали все соединения пула
+openai_semaphores = {
+    "chat": asyncio.Semaphore(int(os.getenv('OPENAI_CHAT_CONCURRENCY', '16'))),
+    "audio": asyncio.Semaphore(int(os.getenv('OPENAI_AUDIO_CONCURRENCY', '4'))),
+    "images": asyncio.Semaphore(int(os.getenv('OPENAI_IMAGES_CONCURRENCY', '2'))),
+}
+# Таймауты запросов в секундах по типам запросов
+openai_timeouts = {
+    "chat": float(os.getenv('OPENAI_CHAT_TIMEOUT', '180')),
+    "audio": float(os.getenv('OPENAI_AUDIO_TIMEOUT', '60')),
+    "images": float(os.getenv('OPENAI_IMAGES_TIMEOUT', '120')),
+}
+
+
+def create_openai_client(api_key) -> AsyncOpenAI:
+    """Асинхронный клиент OpenAI с общим пулом HTTP-соединений."""
+    max_connections = int(os.getenv('OPENAI_MAX_CONNECTIONS', '32'))
+    http_client = openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=60,
+        ),
+        timeout=httpx.Timeout(openai_timeouts["chat"], connect=10.0),
+    )
+    return AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=2)
 
 
 
@@ -180,16 +215,21 @@ functions=[
     },
     {
         "name": "get_all_user_notes",
-        "description": "Получить все заметки пользователя",
+        "description": "Получить список заметок пользователя: заголовки и начало текста. Список выдается страницами, для следующей страницы передай cursor из предыдущего ответа",
 
          "parameters": {
             "type": "object",
-            "properties": {}
+            "properties": {
+                "cursor": {
+                    "type": "string",
+                    "description": "Курсор продолжения списка из предыдущего ответа. Для первой страницы не указывается"
+                }
+            }
         }
     },
     {
         "name": "remove_notes",
-        "description": "Удалить заметку с идентификаторами note_ids",
+        "description": "Удалить заметки пользователя с идентификаторами note_ids",
         "parameters": {
             "type": "object",
             "properties": {
@@ -212,12 +252,8 @@ functions=[
 
 
 
-# Запрос геолокации у пользователя:
-async def request_geolocation(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await add_location_button(update, context)
-
 # 
-def generate_image(openai_client, prompt:str, style:str):
+async def generate_image(openai_client, prompt:str, style:str):
     response = None
     try:
         if prompt is None or prompt == "":
@@ -227,14 +263,16 @@ def generate_image(openai_client, prompt:str, style:str):
         if style  != 'vivid' or style!= 'natural':
             style='vivid'
 
-        response = openai_client.images.generate(
-            model='dall-e-3',
-            prompt=prompt,
-            n=1,
-            size='1024x1024',
-            #quality='hd',  # Опционально: 'standard' или 'hd'
-            style=style  # Опционально: 'vivid' или 'natural'
-            )
+        async with openai_semaphores["images"]:
+            response = await openai_client.images.generate(
+                model='dall-e-3',
+                prompt=prompt,
+                n=1,
+                size='1024x1024',
+                #quality='hd',  # Опционально: 'standard' или 'hd'
+                style=style,  # Опционально: 'vivid' или 'natural'
+                timeout=openai_timeouts["images"]
+                )
         # Получаем первый объект изображения из списка data
         image = response.data[0]
 
@@ -247,13 +285,15 @@ def generate_image(openai_client, prompt:str, style:str):
     # Отправка изображения пользователю
     return image_url
 
-def transcribe_audio(openai_client, audio_filename):
+async def transcribe_audio(openai_client, audio: bytes, file_name="voice.ogg"):
     try:
-         # Распознавание речи с использованием OpenAI
-        transcription = openai_client.audio.transcriptions.create(
-                            model=get_voice_recognition_model(),
-                            file=open(audio_filename, 'rb')
-                            )
+         # Распознавание речи с использованием OpenAI, аудио передается из памяти
+        async with openai_semaphores["audio"]:
+            transcription = await openai_client.audio.transcriptions.create(
+                                model=get_voice_recognition_model(),
+                                file=(file_name, audio),
+                                timeout=openai_timeouts["audio"]
+                                )
         recognized_text=transcription.text
     except Exception as e:
         logging.error("Ошибка при распознавании речи: " + str(e))
@@ -265,206 +305,235 @@ def transcribe_audio(openai_client, audio_filename):
 
 
 
-async def get_model_answer(openai_client, update: Update, context: ContextTypes.DEFAULT_TYPE, messages, recursion_depth=0)->Tuple[str, list[dict], str]:
+#-----------------------------------------------TOOLS-----------------------------------------------------------------------
+
+# Запрос геолокации у пользователя:
+async def request_geolocation(ctx: ToolContext, args: dict) -> ToolResult:
+    await add_location_button(ctx.update, ctx.context)
+    return ToolResult(content="Пользователю показана кнопка отправки геолокации.", stop=True, remember=False)
+
+async def get_weather_description_tool(ctx: ToolContext, args: dict) -> ToolResult:
+    result = await get_weather_description2(args["latitude"], args["longitude"])
+    return ToolResult(content=result)
+
+async def get_weekly_forecast_tool(ctx: ToolContext, args: dict) -> ToolResult:
+    result = await get_weekly_forecast(args["latitude"], args["longitude"])
+    return ToolResult(content=result)
+
+async def get_location_by_address_tool(ctx: ToolContext, args: dict) -> ToolResult:
+    address = args["address"]
+    geoloc = await get_location_by_address(address)
+    if geoloc is None:
+        return ToolResult(reply="Не удалось получить геолокацию.", remember=False)
+    (latitude, longitude) = geoloc
+    result = f"Геолокация {address} установлена. Широта: {latitude}, Долгота: {longitude}"
+    logging.info(result)
+    return ToolResult(content=result)
+
+async def generate_image_tool(ctx: ToolContext, args: dict) -> ToolResult:
+    image_url = await generate_image(ctx.openai_client, args["prompt"], args.get("style"))
+    if image_url is None:
+        return ToolResult(reply="Не удалось сгенерировать изображение. Попробуйте другой prompt или style.", remember=False)
+    # Если генерация прошла успешно, то отправляем пользователю картинку
+    await ctx.update.message.reply_photo(photo=image_url)
+    return ToolResult(content="Изображение сгенерировано и отправлено пользователю.", reply="Я сделал :)", remember=False)
+
+async def change_model_tool(ctx: ToolContext, args: dict) -> ToolResult:
+    new_model_name_str = args["model"]
+    if new_model_name_str == ctx.model_name:
+        return ToolResult(content=f"Модель {new_model_name_str} уже используется.", remember=False)
+    await set_user_model(ctx.user_id, get_OpenAI_Models(new_model_name_str))
+    await reply_service_text(ctx.update, f"Модель успешно изменена на {new_model_name_str}. Модель не поддерживает работу с инструментами (погода, геолокация, картинки и т.д.). Для возврата на стандартную модель сбросьте контекст (/reset)")
+    return ToolResult(content=f"Модель успешно изменена на {new_model_name_str}. Модель не поддерживает работу с инструментами (погода, геолокация, картинки и т.д.).", stop=True)
+
+async def add_note_tool(ctx: ToolContext, args: dict) -> ToolResult:
+    title = args["title"]
     try:
-        logging.info(f"Запрос к модели: {str(messages[-1])}, глубина рекурсии {recursion_depth}")   
+        await add_note(ctx.user_id, title, args["body"], args.get("tags", []))
+    except Exception as e:
+        logging.error(f"Ошибка при добавлении заметки: {e}")
+        await reply_service_text(ctx.update, f"Не удалось добавить заметку '{title}'.")
+        return ToolResult(content=f"Не удалось добавить заметку '{title}': {e}", remember=False)
+    await reply_service_text(ctx.update, f"Заметка '{title}' добавлена.")
+    return ToolResult(content=f"Заметка '{title}' добавлена.", reply="Я сделал :)", remember=False)
+
+async def get_all_user_notes_tool(ctx: ToolContext, args: dict) -> ToolResult:
+    page = await get_notes_page(ctx.user_id, args.get("cursor"))
+    if page.shown == 0:
+        await reply_service_text(ctx.update, "Заметки не найдены.")
+        return ToolResult(content="Заметки не найдены.", stop=True, remember=False)
+    await reply_service_text(ctx.update, f"Найдено {page.total} заметки(-ок).")
+    content = page.system_message_body
+    answer = page.answer
+    if page.cursor is not None:
+        content += f"\nПоказано {page.shown} из {page.total}. Следующая страница: cursor={page.cursor}"
+        answer += f"\nПоказано {page.shown} из {page.total}. Продолжение списка: /show_notes {page.cursor}"
+    return ToolResult(content=content, reply=answer)
+
+async def get_notes_by_query_tool(ctx: ToolContext, args: dict) -> ToolResult:
+    documents = await get_notes_by_query(ctx.user_id, args["search_query"],
+                                         args.get("start_created_date", None), args.get("end_created_date", None))
+    if len(documents) == 0:
+        await reply_service_text(ctx.update, "Заметки не найдены.")
+        return ToolResult(content="Заметки не найдены.", stop=True, remember=False)
+    _, system_message_body = get_notes_text(documents)
+    return ToolResult(content=system_message_body)
+
+async def remove_notes_tool(ctx: ToolContext, args: dict) -> ToolResult:
+    note_ids = [int(x) for x in args["note_ids"]]
+    report = await remove_notes(ctx.user_id, note_ids)
+    if report["failed"] or report["not_found"]:
+        # Модель сообщит пользователю, какие заметки удалить не удалось
+        return ToolResult(content=f"Удалены заметки: {report['deleted']}. Не найдены: {report['not_found']}. "
+                                  f"Ошибка удаления: {[item['NoteId'] for item in report['failed']]}.", remember=False)
+    return ToolResult(content=f"Заметки {report['deleted']} удалены.", reply="Заметки удалены", remember=False)
+
+
+tool_handlers = {
+    "request_geolocation": request_geolocation,
+    "get_weather_description": get_weather_description_tool,
+    "get_weekly_forecast": get_weekly_forecast_tool,
+    "get_location_by_address": get_location_by_address_tool,
+    "generate_image": generate_image_tool,
+    "change_model": change_model_tool,
+    "add_note": add_note_tool,
+    "get_notes_by_query": get_notes_by_query_tool,
+    "get_all_user_notes": get_all_user_notes_tool,
+    "remove_notes": remove_notes_tool,
+}
+
+for function in functions:
+    register_tool(function, tool_handlers[function["name"]])
+
+#-----------------------------------------------end of TOOLS-----------------------------------------------------------------------
+
+# Получает ответ модели потоком, фрагменты текста сразу показываются пользователю через stream_reply
+async def create_streamed_completion(partial_param, stream_reply) -> ChatCompletionMessage:
+    content = []
+    tool_calls = {}  # индекс вызова -> {"id", "name", "arguments"}
+    stream = await partial_param(stream=True, stream_options={"include_usage": True})
+    async for chunk in stream:
+        # Статистика использования токенов приходит последним фрагментом без choices
+        if chunk.usage is not None:
+            record_usage(chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        # Вызовы инструментов приходят по частям, собираем их по индексу
+        for tool_call_delta in delta.tool_calls or []:
+            tool_call = tool_calls.setdefault(tool_call_delta.index, {"id": "", "name": "", "arguments": []})
+            if tool_call_delta.id:
+                tool_call["id"] = tool_call_delta.id
+            if tool_call_delta.function is not None:
+                if tool_call_delta.function.name:
+                    tool_call["name"] += tool_call_delta.function.name
+                if tool_call_delta.function.arguments:
+                    tool_call["arguments"].append(tool_call_delta.function.arguments)
+        if delta.content:
+            content.append(delta.content)
+            try:
+                await stream_reply.push(delta.content)
+            except Exception as e:
+                logging.error(f"Ошибка при показе фрагмента ответа: {e}")
+
+    message_tool_calls = [
+        ChatCompletionMessageToolCall(
+            id=tool_call["id"],
+            type="function",
+            function=Function(name=tool_call["name"], arguments="".join(tool_call["arguments"])),
+        )
+        for _, tool_call in sorted(tool_calls.items())
+    ]
+    return ChatCompletionMessage(role="assistant", content="".join(content), tool_calls=message_tool_calls or None)
 
-        if recursion_depth > MAXIMUM_RECURSION_ANSWER_DEPTH:
-            logging.error("Recursion depth exceeded")
-            return None, None, None
 
+async def get_model_answer(openai_client, update: Update, context: ContextTypes.DEFAULT_TYPE, messages, stream_reply=None)->Tuple[str, list[dict], str]:
+    """Получает ответ модели, выполняя запрошенные ею инструменты.
 
+    Модель может запросить несколько инструментов за один ход - они выполняются параллельно,
+    результаты возвращаются модели, и цикл повторяется до текстового ответа.
+    """
+    try:
         additional_system_messages=[]
         model_name=await get_user_model(update.effective_user.id)
-        
-        partial_param = partial(
-                openai_client.chat.completions.create,
-                model=model_name,
-                messages=messages,
-                functions=functions,
-                function_call="auto",  
-                max_tokens=16384
-            )
-
-        # так как модели o1 не поддерживают сиcтемные сообщения то удалим их
-        if model_name == OpenAI_Models.O1_MINI.value:
-            filtered_messages = [message for message in messages if message["role"] != "system"]
+        tool_context = ToolContext(openai_client, update, context, model_name)
+
+        for tool_round in range(MAXIMUM_TOOL_ROUNDS):
+            logging.info(f"Запрос к модели: {str(messages[-1])}, итерация {tool_round}")
+
             partial_param = partial(
-                openai_client.chat.completions.create,
-                model=model_name,
-                messages=filtered_messages,
-                max_completion_tokens=32768
-            )
-             
-
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            partial_param
-        )
-        
-        if (response.choices and 
-            len(response.choices) > 0 and
-            hasattr(response.choices[0].message, "function_call")):
-    
-            function_call = response.choices[0].message.function_call
-            
-            if function_call and function_call.name == "request_geolocation":
-                # Вызываем функцию запроса геолокации
-                logging.info("Вызываем функцию запроса геолокации")
-                await request_geolocation(update, context)
-                return None, None, None
-            if function_call and (function_call.name == "get_weather_description" or function_call.name == "get_weekly_forecast"):
-                function_args = response.choices[0].message.function_call.arguments
-                logging.info(f"Вызываем функцию запроса погоды. Аргументы: {function_args}, Тип: {type(function_args)}")
-                function_args_dict = json.loads(function_args)
-                latitude=function_args_dict["latitude"]
-                longitude=function_args_dict["longitude"]
-                # Если геолокация есть, то вызываем функцию получения погоды
-                if function_call.name == "get_weather_description":
-                    result = get_weather_description2(latitude, longitude)
-                elif function_call.name == "get_weekly_forecast":
-                    result = get_weekly_forecast(latitude, longitude)
-                    
-                new_system_message={"role": "system", "content": result}
-                additional_system_messages.append(new_system_message)
-                messages.append(new_system_message)
-                (answer, additional_system_messages2, service_after_message) = await get_model_answer(openai_client, update, context, messages, recursion_depth+1)
-                return answer, additional_system_messages+additional_system_messages2, service_after_message
-
-
-            if function_call and function_call.name == "generate_image":
-                function_args = response.choices[0].message.function_call.arguments
-                logging.info(f"Вызываем функцию генерации изображения. Аргументы: {function_args}, Тип: {type(function_args)}")
-                function_args_dict = json.loads(function_args)
-                image_url = generate_image(openai_client, function_args_dict["prompt"], function_args_dict["style"])
-                if image_url is None:
-                    bot_reply = "Не удалось сгенерировать изображение. Попробуйте другой prompt или style."
-                    return bot_reply, additional_system_messages, None
-                else:
-                    # Если генерация прошла успешно, то отправляем пользователю картинку
-                    await update.message.reply_photo(photo=image_url)
-                    bot_reply = "Я сделал :)"
-                    return bot_reply, additional_system_messages, None
-            
-            if function_call and function_call.name == "change_model":
-                function_args = response.choices[0].message.function_call.arguments
-                logging.info(f"Вызываем функцию смены модели. Аргументы: {function_args}, Тип: {type(function_args)}")
-                function_args_dict = json.loads(function_args)
-                new_model_name_str = function_args_dict["model"]
-                new_model_name = get_OpenAI_Models(new_model_name_str)
-                if new_model_name_str!=model_name:
-                    await set_user_model(update.effective_user.id,new_model_name)
-                    await reply_service_text(update, f"Модель успешно изменена на {new_model_name_str}. Модель не поддерживает работу с инструментами (погода, геолокация, картинки и т.д.). Для возврата на стандартную модель сбросьте контекст (/reset)")
-                    new_system_message={"role": "system", "content": f"Модель успешно изменена на {new_model_name_str}. Модель не поддерживает работу с инструментами (погода, геолокация, картинки и т.д.)."}
-                    additional_system_messages.append(new_system_message)
-                    messages.append(new_system_message)
-                    return None,None, None
-            
-            if function_call and function_call.name == "get_location_by_address":
-                function_args = response.choices[0].message.function_call.arguments
-                logging.info(f"Вызываем функцию получения геолокации по адресу. Аргументы: {function_args}, Тип: {type(function_args)}")
-                function_args_dict = json.loads(function_args)
-                address=function_args_dict["address"]
-                geoloc = get_location_by_address(address)
-                if geoloc is None:
-                    bot_reply = "Не удалось получить геолокацию."
-                    return bot_reply, additional_system_messages, None
-                else:
-                    (latitude, longitude) = geoloc
-                    result = f"Геолокация {address} установлена. Широта: {latitude}, Долгота: {longitude}"
-                    logging.info(result)
-                    new_system_message={"role": "system", "content": result}
-                    additional_system_messages.append(new_system_message)
-                    messages.append(new_system_message)
-                    (answer, additional_system_messages2, service_after_message) = await get_model_answer(openai_client, update, context, messages, recursion_depth+1)
-                    return answer, additional_system_messages+additional_system_messages2, service_after_message
-
-            if function_call and (function_call.name == "add_note"):
-                logging.info(f"Function call arguments 1: {response.choices[0]}")
-                logging.info(f"Function call arguments 2: {response.choices[0].message}")
-                logging.info(f"Function call arguments 3: {response.choices[0].message.function_call}")
-                logging.info(f"Function call arguments 4: {response.choices[0].message.function_call.arguments}")
-
-                function_args = response.choices[0].message.function_call.arguments
-                logging.info(f"Вызываем функцию добавления заметки. Аргументы: {function_args}, Тип: {type(function_args)}")
-                # Если function_args это строка, парсим её
-                if isinstance(function_args, str):
-                    function_args_dict = json.loads(function_args)
+                    openai_client.chat.completions.create,
+                    model=model_name,
+                    messages=prepare_messages(messages),
+                    tools=get_tool_schemas(),
+                    tool_choice="auto",
+                    parallel_tool_calls=True,
+                    max_tokens=16384,
+                    timeout=openai_timeouts["chat"]
+                )
+
+            # так как модели o1 не поддерживают сиcтемные сообщения и инструменты, то удалим их
+            if model_name == OpenAI_Models.O1_MINI.value:
+                filtered_messages = [message for message in messages if message["role"] != "system"]
+                partial_param = partial(
+                    openai_client.chat.completions.create,
+                    model=model_name,
+                    messages=prepare_messages(filtered_messages),
+                    max_completion_tokens=32768,
+                    timeout=openai_timeouts["chat"]
+                )
+
+            async with openai_semaphores["chat"]:
+                if stream_reply is not None:
+                    message = await create_streamed_completion(partial_param, stream_reply)
                 else:
-                    function_args_dict = function_args  # если это уже словарь
-                
-                title=function_args_dict["title"]
-                body=function_args_dict["body"]
-                tags=function_args_dict["tags"]
-                
-                add_note(update.effective_user.id,title, body, tags)
-                await reply_service_text(update,f"Заметка '{title}' добавлена.")
-                bot_reply = "Я сделал :)"
-                return bot_reply, additional_system_messages, None
-                
-
-            if function_call and (function_call.name == "get_all_user_notes"):
-                logging.info(f"Вызываем функцию получения всех заметок.")
-                documents = get_all_user_notes(update.effective_user.id)
-                
-                if len(documents) == 0:
-                    await reply_service_text(update,"Заметки не найдены.")
-                    return None, None, None
-                
-                answer, system_message_body = get_notes_text(documents)
-
-                new_system_message={"role": "system", "content": system_message_body}
-                additional_system_messages.append(new_system_message)
-                messages.append(new_system_message)
-                
-                await reply_service_text(update,f"Найдено {len(documents)} заметки(-ок).")
-                return answer, additional_system_messages, None
-            
-            if function_call and (function_call.name == "get_notes_by_query"):
-                function_args = response.choices[0].message.function_call.arguments
-                logging.info(f"Вызываем функцию поиска заметки. Аргументы: {function_args}, Тип: {type(function_args)}")
-                function_args_dict = json.loads(function_args)
-                search_query=function_args_dict["search_query"]
-                start_date=function_args_dict.get("start_created_date",None)
-                end_date=function_args_dict.get("end_created_date",None)
-
-                
-                documents = get_notes_by_query(update.effective_user.id, search_query, start_date, end_date)
-                if len(documents) == 0:
-                    await reply_service_text(update,"Заметки не найдены.")
-                    return None, None, None
-                
-                answer, system_message_body = get_notes_text(documents)
-                new_system_message={"role": "system", "content": system_message_body}
-                additional_system_messages.append(new_system_message)
-                messages.append(new_system_message)
-                (answer, additional_system_messages2, service_after_message) = await get_model_answer(openai_client, update, context, messages, recursion_depth+1)
-                return answer, additional_system_messages+additional_system_messages2, service_after_message
-
-            if function_call and (function_call.name == "remove_notes"):
-                function_args = response.choices[0].message.function_call.arguments
-                logging.info(f"Вызываем функцию удаления заметок. Аргументы: {function_args}, Тип: {type(function_args)}")
-                # Если function_args это строка, парсим её
-                if isinstance(function_args, str):
-                    function_args_dict = json.loads(function_args)
-                else:
-                    function_args_dict = function_args  # если это уже словарь
-                
-                note_ids=[int(x) for x in function_args_dict["note_ids"]]
-                await remove_notes(note_ids)
-                bot_reply = "Заметки удалены"
-                return bot_reply, additional_system_messages, None  
+                    response = await partial_param()
+                    record_usage(response.usage)
+                    message = response.choices[0].message if response.choices else None
 
+            if message is None:
+                logging.error("Модель не вернула ответ")
+                return None, None, None
 
-   
-        # Если функция не вызвалась, возвращаем обычный текстовый ответ:
-        bot_reply = response.choices[0].message.content.strip()
-        return bot_reply, additional_system_messages, None
+            # Если инструменты не вызывались, возвращаем обычный текстовый ответ:
+            if not message.tool_calls:
+                bot_reply = (message.content or "").strip()
+                return bot_reply, additional_system_messages, None
+
+            messages.append({
+                "role": "assistant",
+                "content": message.content,
+                "tool_calls": [
+                    {
+                        "id": tool_call.id,
+                        "type": "function",
+                        "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments},
+                    }
+                    for tool_call in message.tool_calls
+                ],
+            })
+
+            # Все запрошенные инструменты выполняются параллельно
+            results = await asyncio.gather(*(execute_tool_call(tool_call, tool_context) for tool_call in message.tool_calls))
+
+            replies = []
+            stop = False
+            for tool_call, result in zip(message.tool_calls, results):
+                messages.append({"role": "tool", "tool_call_id": tool_call.id, "content": result.content or ""})
+                if result.remember and result.content:
+                    # Результат сохраняется в истории для следующих ходов беседы
+                    additional_system_messages.append({"role": "system", "content": result.content})
+                if result.reply is not None:
+                    replies.append(result.reply)
+                stop = stop or result.is_final
+
+            if stop:
+                return ("\n".join(replies) if replies else None), additional_system_messages, None
+
+        logging.error("Превышено количество обращений к модели за один ответ")
+        return None, additional_system_messages, None
 
     except Exception as e:
         # Логируем ошибки
         logging.error(f"Ошибка при обращении к OpenAI API: {e}", exc_info=True)
         return "Произошла ошибка при обработке запроса.", None, None
-
-
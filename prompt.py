@@ -0,0 +1,70 @@
+import logging
+
+from state_and_commands import get_local_time
+from token_budget import count_message_tokens
+
+# Порядок сообщений в запросе - от самого стабильного к самому изменчивому: постоянные инструкции,
+# затем (в параметрах запроса) схемы инструментов, старая история, текущее время и новая реплика.
+# Так у соседних запросов совпадает максимально длинный префикс и срабатывает кэширование промпта.
+
+system_instructions = """
+Вы — личный помощник, который отвечает на вопросы пользователя. Текущее время по Москве сообщается отдельным системным сообщением перед последним сообщением пользователя.
+1. Если для ответа на вопрос пользователя требуется прогноз погоды и он уже есть в истории сообщений или системной информации, используй его. В противном случае вызови функцию get_weather_description.
+
+2. Если для ответа требуется геолокация пользователя и она доступна в истории сообщений или системной информации, используй ее. Иначе запроси геолокацию через функцию request_geolocation.
+
+3. Если пользователь просит сгенерировать изображение, используй функцию generate_image.
+
+4. Если пользователь хочет что-то сохранить, добавь это в заметки в базе Elasticsearch, используя функцию add_note. Если в заметках присутствуют относительные временные указания (например, дни недели, "завтра", "в прошлом месяце"), по возможности, преобразуй их в точные даты относительно текущей и сохрани эти даты в заметках.
+
+5. Для умного поиска заметок в Elasticsearch используй функцию get_notes_by_query. Поиск можно выполнять по полям Title, Body, Tags.
+    - Если пользователь запрашивает заметку о событии, используя относительное время, преобразуй его в абсолютное (точная дата, номер недели в году, название месяца) и используй при поиске по search_query.
+    - Для поиска заметок по дате создания используй параметры функции start_created_date и end_created_date.
+    - На вопрос о поиске событий в заметках не используй параметры start_created_date и end_created_date, потому что они о создании заметки, а не о событии внутри нее.
+
+6. Ответ преобразуй в ответ в разметке MarkdownV2, экранируя соответсвующие символы.
+"""
+
+static_system_message = {"role": "system", "content": system_instructions}
+
+weekdays = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
+
+# Статистика кэширования промпта по данным API
+prompt_cache_stats = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+
+def get_time_message():
+    # Время с точностью до минуты, чтобы сообщение менялось как можно реже
+    local_time = get_local_time()
+    return {
+        "role": "system",
+        "content": f"Текущее время по Москве: {local_time.strftime('%Y-%m-%d %H:%M')}, {weekdays[local_time.weekday()]}.",
+    }
+
+
+def build_messages(history: list[dict]) -> list[dict]:
+    """Собирает сообщения запроса: инструкции, история, текущее время и последняя реплика."""
+    return [static_system_message] + history[:-1] + [get_time_message()] + history[-1:]
+
+
+def get_fixed_prompt_tokens() -> int:
+    """Токены, которые занимают в запросе сообщения помимо истории."""
+    return count_message_tokens(static_system_message) + count_message_tokens(get_time_message())
+
+
+def record_usage(usage):
+    """Учитывает, сколько токенов запроса API взял из кэша."""
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (details.cached_tokens or 0) if details is not None else 0
+    prompt_cache_stats["requests"] += 1
+    prompt_cache_stats["prompt_tokens"] += usage.prompt_tokens
+    prompt_cache_stats["cached_tokens"] += cached_tokens
+    logging.info(f"Токены запроса: {usage.prompt_tokens}, из кэша: {cached_tokens}, ответа: {usage.completion_tokens}")
+
+
+def get_prompt_cache_stats() -> dict:
+    stats = dict(prompt_cache_stats)
+    stats["hit_rate"] = round(stats["cached_tokens"] / stats["prompt_tokens"], 4) if stats["prompt_tokens"] else 0.0
+    return stats
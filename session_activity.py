@@ -0,0 +1,49 @@
+import asyncio
+import logging
+import os
+
+from sql import save_last_sessions
+
+
+class SessionActivityBuffer:
+    """Отложенная запись времени последней сессии пользователей.
+
+    Обращения накапливаются в памяти (по одной записи на пользователя, последняя побеждает)
+    и записываются в MySQL одним запросом раз в flush_interval секунд и при остановке.
+    """
+
+    def __init__(self, flush_interval=30.0):
+        self.flush_interval = flush_interval
+        self.pending = {}  # user_id -> (username, время сессии)
+        self.recorded = 0
+        self.flushed = 0
+
+    def record(self, user_id, username, session_time):
+        self.pending[user_id] = (username, session_time)
+        self.recorded += 1
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        try:
+            await save_last_sessions([(user_id, username, session_time)
+                                      for user_id, (username, session_time) in batch.items()])
+            self.flushed += len(batch)
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении последних сессий: {e}")
+            # Возвращаем несохраненные записи, если пользователь не успел обратиться заново
+            for user_id, value in batch.items():
+                self.pending.setdefault(user_id, value)
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def get_stats(self) -> dict:
+        return {"pending": len(self.pending), "recorded": self.recorded, "flushed": self.flushed}
+
+
+def create_session_activity_from_os():
+    return SessionActivityBuffer(float(os.getenv('SESSION_FLUSH_INTERVAL', '30')))
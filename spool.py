@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import time
+from collections import deque
+
+from local_db import connect_sqlite, get_local_db_path
+
+spool_table_name = 'updates'
+
+
+class UpdateSpool:
+    """Журнал входящих обновлений Telegram в локальной SQLite-базе.
+
+    Вебхук записывает обновление в журнал до ответа Telegram, после обработки обновление
+    помечается выполненным. Необработанные обновления повторно обрабатываются при старте,
+    а повторные доставки отсекаются по update_id.
+    """
+
+    def __init__(self, path, dedup_window=10000):
+        self.connection = connect_sqlite(path)
+        self.dedup_window = dedup_window
+        self.connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {spool_table_name} (
+                update_id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                received_at REAL NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        # Окно последних update_id в памяти, чтобы повторы отсекались без обращения к базе
+        rows = self.connection.execute(
+            f"SELECT update_id FROM {spool_table_name} ORDER BY update_id DESC LIMIT ?", (dedup_window,)
+        ).fetchall()
+        self.recent_order = deque(reversed([row[0] for row in rows]))
+        self.recent_ids = set(self.recent_order)
+        self.appended_since_prune = 0
+
+    def append(self, update_id: int, payload: str) -> bool:
+        """Записывает обновление в журнал. Возвращает False, если такое обновление уже было."""
+        if update_id in self.recent_ids:
+            return False
+        cursor = self.connection.execute(
+            f"INSERT OR IGNORE INTO {spool_table_name} (update_id, payload, received_at) VALUES (?, ?, ?)",
+            (update_id, payload, time.time()))
+        if cursor.rowcount == 0:
+            return False
+        self._remember(update_id)
+        self.appended_since_prune += 1
+        if self.appended_since_prune >= self.dedup_window // 10:
+            self.prune()
+        return True
+
+    def _remember(self, update_id):
+        self.recent_ids.add(update_id)
+        self.recent_order.append(update_id)
+        while len(self.recent_order) > self.dedup_window:
+            self.recent_ids.discard(self.recent_order.popleft())
+
+    def mark_done(self, update_id: int):
+        self.connection.execute(f"UPDATE {spool_table_name} SET done = 1 WHERE update_id = ?", (update_id,))
+
+    def discard(self, update_id: int):
+        """Удаляет непринятое обновление, чтобы повторная доставка не была отброшена как дубликат."""
+        self.connection.execute(f"DELETE FROM {spool_table_name} WHERE update_id = ?", (update_id,))
+        if update_id in self.recent_ids:
+            self.recent_ids.discard(update_id)
+            self.recent_order.remove(update_id)
+
+    def get_pending(self) -> list[tuple[int, dict]]:
+        rows = self.connection.execute(
+            f"SELECT update_id, payload FROM {spool_table_name} WHERE done = 0 ORDER BY update_id"
+        ).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def prune(self):
+        """Удаляет обработанные обновления, вышедшие за окно дедупликации."""
+        self.appended_since_prune = 0
+        self.connection.execute(f"""
+            DELETE FROM {spool_table_name}
+            WHERE done = 1 AND update_id <= (SELECT MAX(update_id) FROM {spool_table_name}) - ?
+        """, (self.dedup_window,))
+
+    def close(self):
+        self.prune()
+        self.connection.close()
+
+
+def create_spool_from_os() -> UpdateSpool:
+    path = get_local_db_path(os.getenv('SPOOL_DB_FILE', 'update_spool.sqlite'))
+    dedup_window = int(os.getenv('SPOOL_DEDUP_WINDOW', '10000'))
+    spool = UpdateSpool(path, dedup_window)
+    logging.info(f"Update spool: {path}, dedup window {dedup_window}")
+    return spool
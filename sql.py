@@ -1,9 +1,13 @@
+import asyncio
 import os
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import mysql.connector
+import mysql.connector.pooling
 
-from common_types import SafeList
+from access_index import AccessIndex
 
 # Получение параметров подключения из переменных окружения
 MYSQL_HOST = os.getenv('MYSQL_ADDON_HOST')
@@ -17,8 +21,8 @@ logging.basicConfig(level=logging.INFO)
 
 # администраторы
 administrators_ids = []
-# пользователи
-user_ids= SafeList([])
+# индекс допустимых пользователей и администраторов
+access_index = AccessIndex()
 
 user_ids_table_name= 'user_ids'
 last_session_table_name = 'last_session_big_int'
@@ -28,33 +32,105 @@ def get_admins():
     return administrators_ids
 
 async def get_all():
-    return await user_ids.get_all()
+    return access_index.get_users()
+
+def get_access_index():
+    return access_index
 
 #----------------------------------MySQL------------------------------------------
-if not all([MYSQL_HOST, MYSQL_DB, MYSQL_USER, MYSQL_PASSWORD]):
-    raise EnvironmentError("Не установлены все необходимые переменные окружения для подключения к MySQL.")
+MYSQL_POOL_SIZE = int(os.getenv('MYSQL_POOL_SIZE', '5'))
+MYSQL_RETRIES = int(os.getenv('MYSQL_RETRIES', '5'))
+MYSQL_RETRY_BACKOFF = float(os.getenv('MYSQL_RETRY_BACKOFF', '0.5'))
+
+# Ошибки соединения, после которых запрос стоит повторить
+retryable_errors = (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError, mysql.connector.errors.PoolError)
+
+# Пул постоянных соединений и отдельный пул потоков для запросов, чтобы не занимать цикл событий
+connection_pool = None
+db_executor = ThreadPoolExecutor(max_workers=MYSQL_POOL_SIZE, thread_name_prefix="mysql")
+
+
+def create_connection_pool():
+    global connection_pool
+    connection_pool = mysql.connector.pooling.MySQLConnectionPool(
+        pool_name="telegram_bot",
+        pool_size=MYSQL_POOL_SIZE,
+        pool_reset_session=True,
+        host=MYSQL_HOST,
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        database=MYSQL_DB,
+        port=MYSQL_PORT
+    )
+    logging.info(f"MySQL connection pool created, size {MYSQL_POOL_SIZE}")
+
 
-def connect_to_db():
-    count = 0
+def connect_to_db(timeout=10.0):
+    """Берет соединение из пула. close() возвращает его обратно в пул.
+
+    При выдаче пул проверяет соединение (is_connected) и переподключает разорванные.
+    Если свободных соединений нет, ждет освобождения не дольше timeout секунд.
+    Вызывается только из рабочих потоков.
+    """
+    deadline = time.monotonic() + timeout
     while True:
         try:
-            return mysql.connector.connect(
-                host=MYSQL_HOST,
-                user=MYSQL_USER,
-                password=MYSQL_PASSWORD,
-                database=MYSQL_DB,
-                port=MYSQL_PORT
-            )
-        except mysql.connector.Error as err:
-            logging.error(f"Ошибка подключения к MySQL: {err}. Попытка {count} из 10.")
-            count += 1
-            if count > 10:
+            return connection_pool.get_connection()
+        except mysql.connector.errors.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+def execute_query(query, params=None, fetch=False, many=False):
+    connection = connect_to_db()
+    cursor = None
+    try:
+        cursor = connection.cursor()
+        if many:
+            cursor.executemany(query, params)
+        else:
+            cursor.execute(query, params)
+        if fetch:
+            return cursor.fetchall()
+        connection.commit()
+    finally:
+        if cursor is not None:
+            cursor.close()
+        connection.close()
+
+
+async def run_db(fn, *args, retry_on=retryable_errors):
+    """Выполняет fn в пуле потоков MySQL, повторяя при ошибках соединения с неблокирующей паузой.
+
+    Ответ на уже выполненный запрос может потеряться вместе с соединением, поэтому запросы,
+    выполняемые через run_db, должны быть идемпотентными: повтор не должен менять результат.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(MYSQL_RETRIES + 1):
+        try:
+            return await loop.run_in_executor(db_executor, partial(fn, *args))
+        except retry_on as err:
+            if attempt >= MYSQL_RETRIES:
                 logging.error("Подключение к MySQL не удалось.")
                 raise
-            else:
-                # ждем 5 секунд
-                time.sleep(5)
-                continue
+            logging.error(f"Ошибка подключения к MySQL: {err}. Попытка {attempt + 1} из {MYSQL_RETRIES}.")
+            await asyncio.sleep(MYSQL_RETRY_BACKOFF * 2 ** attempt)
+
+
+async def run_query(query, params=None, fetch=False, many=False):
+    return await run_db(execute_query, query, params, fetch, many)
+
+
+async def init_db():
+    """Создает пул соединений и таблицы и загружает индекс доступа. Вызывается при старте бота."""
+    if not all([MYSQL_HOST, MYSQL_DB, MYSQL_USER, MYSQL_PASSWORD]):
+        raise EnvironmentError("Не установлены все необходимые переменные окружения для подключения к MySQL.")
+    get_admins_from_os()
+    # При холодном старте MySQL может быть еще недоступен - повторяем при любой ошибке подключения
+    await run_db(create_connection_pool, retry_on=mysql.connector.Error)
+    await run_db(create_tables)
+    await refresh_user_ids()
 
 
 def create_tables():
@@ -63,120 +139,97 @@ def create_tables():
 
 def create_user_id_table():
     """Создает таблицу для хранения идентификаторов пользователей."""
-    connection = connect_to_db()
     try:
-        cursor = connection.cursor()
-        cursor.execute(f"""
+        execute_query(f"""
             CREATE TABLE IF NOT EXISTS {user_ids_table_name} (
                 id BIGINT AUTO_INCREMENT PRIMARY KEY,
                 user_id BIGINT NOT NULL
             )
         """)
-        connection.commit()
     except mysql.connector.Error as err:
         logging.error(f"Ошибка создания таблицы в MySQL: {err}")
         raise
-    finally:
-        cursor.close()
-        connection.close()
 
 
 
 async def save_user_id(user_id):
-    if user_id not in await user_ids.get_all():
-        await user_ids.append(user_id)
     """Сохраняет идентификатор пользователя в базу данных."""
-    connection = connect_to_db()
+    access_index.add(user_id)
     try:
-        cursor = connection.cursor()
-        cursor.execute(f"INSERT INTO {user_ids_table_name} (user_id) VALUES (%s)", (user_id,))
-        connection.commit()
+        # Вставка только отсутствующего пользователя: повтор после потерянного ответа не создает дубликат
+        await run_query(f"""
+            INSERT INTO {user_ids_table_name} (user_id)
+            SELECT %s FROM DUAL WHERE NOT EXISTS (SELECT 1 FROM {user_ids_table_name} WHERE user_id = %s)
+            """, (user_id, user_id))
     except mysql.connector.Error as err:
         logging.error(f"Ошибка сохранения пользователя в MySQL: {err}")
         raise
-    finally:
-        cursor.close()
-        connection.close()
 
 def get_user_ids():
     """Получает все идентификаторы пользователей из базы данных."""
-    connection = connect_to_db()
     try:
-        cursor = connection.cursor()
-        cursor.execute(f"SELECT DISTINCT user_id FROM {user_ids_table_name}")
-        result = cursor.fetchall()
+        result = execute_query(f"SELECT DISTINCT user_id FROM {user_ids_table_name}", fetch=True)
         return [row[0] for row in result]
     except mysql.connector.Error as err:
         logging.error(f"Ошибка получения пользователей из MySQL: {err}")
         raise
-    finally:
-        cursor.close()
-        connection.close()
+
+async def refresh_user_ids():
+    """Перечитывает список пользователей из базы данных в индекс доступа."""
+    access_index.set_users(await run_db(get_user_ids))
+
+async def run_user_ids_refresher(interval):
+    """Периодически обновляет индекс доступа, чтобы подхватить изменения из других экземпляров бота."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh_user_ids()
+        except Exception as e:
+            logging.error(f"Ошибка при обновлении списка пользователей: {e}")
 
 async def remove_user_id(user_id):
-    await user_ids.remove(user_id)
     """Удаляет идентификатор пользователя из базы данных."""
-    connection = connect_to_db()
+    access_index.remove(user_id)
     try:
-        cursor = connection.cursor()
-        cursor.execute(f"DELETE FROM {user_ids_table_name} WHERE user_id = %s", (user_id,))
-        connection.commit()
+        await run_query(f"DELETE FROM {user_ids_table_name} WHERE user_id = %s", (user_id,))
     except mysql.connector.Error as err:
         logging.error(f"Ошибка удаления пользователя из MySQL: {err}")
         raise
-    finally:
-        cursor.close()
-        connection.close()
 
 def create_last_session_table():
     """Создает таблицу для хранения последней сессии."""
-    connection = connect_to_db()
     try:
-        cursor = connection.cursor()
-        cursor.execute(f"""
+        execute_query(f"""
         CREATE TABLE IF NOT EXISTS {last_session_table_name} (
         userid BIGINT AUTO_INCREMENT PRIMARY KEY,
         username VARCHAR(255) NOT NULL,
         last_session_time DATETIME
     )
         """)
-        connection.commit()
     except mysql.connector.Error as err:
         logging.error(f"Ошибка создания таблицы в MySQL: {err}")
         raise
-    finally:
-        cursor.close()
-        connection.close()
-
-async def save_last_session(user_id, username, last_session_time):
-    if user_id not in await user_ids.get_all():
-        await user_ids.append(user_id)
 
-    if username is None or username == '':
-        username = 'NDU'
-
-    connection = connect_to_db()
+async def save_last_sessions(sessions: list[tuple]):
+    """Сохраняет последние сессии пачкой одним запросом. sessions - список (user_id, username, last_session_time)."""
+    if not sessions:
+        return
+    rows = [(user_id, username or 'NDU', last_session_time) for user_id, username, last_session_time in sessions]
+    placeholders = ", ".join(["(%s, %s, %s)"] * len(rows))
+    params = [value for row in rows for value in row]
     try:
-        cursor = connection.cursor()
-        cursor.execute(  f"""
-                INSERT INTO {last_session_table_name} (userid, username, last_session_time) VALUES (%s, %s, %s)
+        await run_query(f"""
+                INSERT INTO {last_session_table_name} (userid, username, last_session_time) VALUES {placeholders}
                 ON DUPLICATE KEY UPDATE username = VALUES(username), last_session_time = VALUES(last_session_time)
                 """,
-                (user_id, username, last_session_time))
-
-        connection.commit()
+                params)
     except mysql.connector.Error as err:
         logging.error(f"Ошибка сохранения последней сессии в MySQL: {err}")
         raise
-    finally:
-        cursor.close()
-        connection.close()
 
-def get_all_session():
-    connection = connect_to_db()
+async def get_all_session():
     try:
-        cursor = connection.cursor()
-        cursor.execute(f"""
+        result = await run_query(f"""
         SELECT 
             userid, 
             username, 
@@ -186,16 +239,11 @@ def get_all_session():
         ORDER BY 
             last_session_time DESC 
         LIMIT 10;
-        """)
-
-        result = cursor.fetchall()
+        """, fetch=True)
         return [{"userid": row[0], "username": row[1], "last_session_time": row[2]} for row in result]
     except mysql.connector.Error as err:
         logging.error(f"Ошибка при получении пользователей из MySQL: {err}")
         raise
-    finally:
-        cursor.close()
-        connection.close()
 
 
 
@@ -208,18 +256,11 @@ def get_admins_from_os():
         int(uid.strip()) for uid in allowed_users_str.split(',') if uid.strip().isdigit()
     ]
     logging.info(f"Admins uploaded from environment. Ids - {administrators_ids}")
+    access_index.set_admins(administrators_ids)
 
 def in_admin_list(user):
-    return user.id in administrators_ids
+    return access_index.is_admin(user.id)
 async def in_user_list(user):
-    temp_user_ids = await get_all()
-    return user.id in temp_user_ids or in_admin_list(user)
+    return access_index.is_allowed(user.id)
 
 #-------------------------------------end function block-------------------------------------------------------
-
-# Получение списка администраторов из переменной окружения
-get_admins_from_os() 
-# Получение списка пользователей из переменной окружения
-connect_to_db()
-create_tables()
-user_ids=SafeList(get_user_ids())
\ No newline at end of file
@@ -2,6 +2,7 @@
 import datetime
 from enum import Enum, unique
 import logging
+import os
 from zoneinfo import ZoneInfo
 
 from telegram import KeyboardButton, ReplyKeyboardMarkup, Update
@@ -13,8 +14,11 @@ from telegram.ext import (
     filters,
 )
 
-from common_types import SafeDict
-from sql import get_admins, get_all, get_all_session, in_admin_list, in_user_list, remove_user_id, save_last_session, save_user_id
+from history_store import create_history_store_from_os
+from images import create_image_store_from_os
+from session_activity import create_session_activity_from_os
+from sql import get_access_index, get_admins, get_all, get_all_session, in_admin_list, in_user_list, remove_user_id, save_user_id
+from state_store import StateStore, memory_budget
 from telegram.helpers import escape_markdown
 @unique
 class OpenAI_Models(Enum):
@@ -24,11 +28,18 @@ class OpenAI_Models(Enum):
 parse_mode="MarkdownV2"
 
 
-user_histories = SafeDict()
-translate_mode=SafeDict()
+# История хранится в памяти для активных пользователей и сохраняется в постоянное хранилище
+user_histories = create_history_store_from_os(StateStore(
+    "user_histories",
+    max_entries=int(os.getenv('HISTORY_MAX_USERS', '1000')),
+    ttl=float(os.getenv('HISTORY_TTL', str(7 * 24 * 3600))),
+))
+translate_mode=StateStore("translate_mode", max_entries=10000)
 
-user_image = SafeDict()
-user_model = SafeDict()
+user_image = create_image_store_from_os()
+user_model = StateStore("user_model", max_entries=10000)
+# время последних сессий, записывается в MySQL пачками
+session_activity = create_session_activity_from_os()
 
 # получает название модели в виде enum из строки
 def get_OpenAI_Models(model: str) -> OpenAI_Models:
@@ -50,7 +61,7 @@ async def get_user_model(user_id):
     else:
         return model
 
-async def set_user_image(user_id, image:str):
+async def set_user_image(user_id, image:dict):
     await user_image.set(user_id,image)
 async def get_user_image(user_id):
     return await user_image.get(user_id, None)
@@ -58,10 +69,21 @@ async def get_user_image(user_id):
 def get_history():
     return user_histories
 
+def get_session_activity():
+    return session_activity
+
+def get_state_stats() -> dict:
+    stats = {store.name: store.get_stats() for store in (user_histories, translate_mode, user_image, user_model)}
+    stats["session_activity"] = session_activity.get_stats()
+    stats["access_index"] = get_access_index().get_stats()
+    stats["memory_budget"] = {"used": memory_budget.used, "limit": memory_budget.limit}
+    return stats
+
 async def set_session_info(user) -> None:
     # Получение текущего времени в формате UTC
     local_time = get_local_time()
-    await save_last_session(user.id, user.username, local_time)
+    # Запись в MySQL выполняется пачкой в фоне
+    session_activity.record(user.id, user.username, local_time)
 
 def get_local_time():
     utc_time = datetime.datetime.now(ZoneInfo("UTC"))    
@@ -139,9 +161,8 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             return
 
         new_user_id = int(context.args[0])
-        temp_user_ids = await get_all()
 
-        if new_user_id not in temp_user_ids:
+        if not get_access_index().is_user(new_user_id):
             await save_user_id(new_user_id)
             await reply_service_text(update,"Пользователь добавлен в список допустимых.")
         else:
@@ -161,8 +182,7 @@ async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             return
         
         new_user_id = int(context.args[0])
-        temp_user_ids = await get_all()
-        if new_user_id in temp_user_ids:
+        if get_access_index().is_user(new_user_id):
             
             await remove_user_id(new_user_id)
             await reply_service_text(update,"Пользователь удален из списка допустимых.")
@@ -182,7 +202,7 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 async def get_last_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if in_admin_list(user):
-        last_sessions= get_all_session()
+        last_sessions= await get_all_session()
         if len(last_sessions)==0:
             await reply_service_text(update,"Список последних сессий пользователей пуст.")
             return
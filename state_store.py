@@ -0,0 +1,168 @@
+import asyncio
+import inspect
+import logging
+import os
+import time
+from collections import OrderedDict
+
+
+def estimate_size(value) -> int:
+    """Приблизительный размер значения в байтах (учитываются строки и байты)."""
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(estimate_size(k) + estimate_size(v) for k, v in value.items()) + 64
+    if isinstance(value, (list, tuple, set)):
+        return sum(estimate_size(item) for item in value) + 56
+    return 32
+
+
+class MemoryBudget:
+    """Общий лимит памяти для нескольких хранилищ состояния."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+    def is_exceeded(self) -> bool:
+        return self.used > self.limit
+
+
+memory_budget = MemoryBudget(int(os.getenv('STATE_MEMORY_BUDGET', str(256 * 1024 * 1024))))
+
+
+class StateStore:
+    """Хранилище состояния пользователей с блокировками по ключу и вытеснением.
+
+    Блокировки распределены по шардам, поэтому пользователи не ждут друг друга.
+    Записи вытесняются по времени жизни с последнего обращения, по давности использования (LRU) при превышении
+    количества записей, лимита размера хранилища или общего бюджета памяти.
+    Размер записи учитывается только при set и update: значение, полученное через get,
+    нельзя изменять на месте - измененное значение сохраняется через set или update.
+    """
+
+    def __init__(self, name, max_entries=None, ttl=None, max_bytes=None, shards=16,
+                 sizer=estimate_size, budget=memory_budget, on_evict=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizer = sizer
+        self.budget = budget
+        # Вызывается с (ключ, значение) для каждой вытесненной записи
+        self.on_evict = on_evict
+        self.locks = [asyncio.Lock() for _ in range(shards)]
+        self.data = OrderedDict()  # ключ -> (время истечения, размер, значение)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lock(self, key) -> asyncio.Lock:
+        return self.locks[hash(key) % len(self.locks)]
+
+    async def get(self, key, default_value):
+        async with self._lock(key):
+            return self._get(key, default_value)
+
+    async def set(self, key, value):
+        async with self._lock(key):
+            self._set(key, value)
+
+    async def delete(self, key):
+        async with self._lock(key):
+            self._remove(key)
+
+    async def update(self, key, fn, default_value=None):
+        """Атомарно читает значение, передает его в fn и сохраняет результат.
+
+        fn может быть как обычной функцией, так и корутиной - блокировка ключа
+        удерживается до сохранения результата.
+        """
+        async with self._lock(key):
+            result = fn(self._get(key, default_value))
+            if inspect.isawaitable(result):
+                result = await result
+            self._set(key, result)
+            return result
+
+    def _get(self, key, default_value):
+        item = self.data.get(key)
+        if item is None:
+            self.misses += 1
+            return default_value
+        expires_at, _, value = item
+        if expires_at is not None and expires_at < time.monotonic():
+            self._evict(key)
+            self.misses += 1
+            return default_value
+        # Время жизни отсчитывается от последнего обращения, поэтому порядок LRU совпадает с порядком истечения
+        if self.ttl is not None:
+            self.data[key] = (time.monotonic() + self.ttl, item[1], value)
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _set(self, key, value):
+        self._remove(key)
+        if value is None:
+            return
+        # Размер измеряется заново при каждой записи, в том числе если fn в update вернула тот же объект
+        size = self.sizer(value)
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.data[key] = (expires_at, size, value)
+        self.total_bytes += size
+        if self.budget is not None:
+            self.budget.used += size
+        self._evict_overflow(key)
+
+    def _remove(self, key):
+        item = self.data.pop(key, None)
+        if item is None:
+            return None
+        size = item[1]
+        self.total_bytes -= size
+        if self.budget is not None:
+            self.budget.used -= size
+        return item[2]
+
+    def _evict(self, key):
+        value = self._remove(key)
+        self.evictions += 1
+        if self.on_evict is not None:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logging.error(f"Ошибка при вытеснении записи {key} из {self.name}: {e}")
+
+    def _is_overflow(self) -> bool:
+        return ((self.max_entries is not None and len(self.data) > self.max_entries)
+                or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+                or (self.budget is not None and self.budget.is_exceeded()))
+
+    def _evict_overflow(self, protected_key):
+        now = time.monotonic()
+        # Записи упорядочены по последнему обращению: в начале - просроченные и самые давно использованные
+        while self.data:
+            key = next(iter(self.data))
+            if key == protected_key:
+                break
+            expires_at = self.data[key][0]
+            if expires_at is not None and expires_at < now:
+                self._evict(key)
+            elif self._is_overflow():
+                self._evict(key)
+                logging.info(f"Запись {key} вытеснена из {self.name}")
+            else:
+                break
+
+    def get_stats(self) -> dict:
+        return {
+            "entries": len(self.data),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+import time
+
+from telegram import Update
+from telegram.error import BadRequest, RetryAfter
+
+from state_and_commands import parse_mode
+
+# Максимальная длина одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Минимальный интервал между редактированиями сообщения (лимиты Telegram - около одного в секунду на чат)
+stream_edit_interval = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+stream_replies_enabled = os.getenv('STREAM_REPLIES', 'true').lower() in ('1', 'true', 'yes')
+
+placeholder_text = "⏳"
+
+
+def is_stream_replies_enabled() -> bool:
+    return stream_replies_enabled
+
+
+def is_not_modified(error: BadRequest) -> bool:
+    return "not modified" in str(error).lower()
+
+
+def split_text(text: str) -> list[str]:
+    return [text[i:i + TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(text), TELEGRAM_MESSAGE_LIMIT)] or [""]
+
+
+class StreamingReply:
+    """Ответ, который показывается пользователю по мере генерации.
+
+    Первым отправляется сообщение-заглушка, затем оно редактируется по мере поступления текста
+    не чаще stream_edit_interval. При превышении 4096 символов текст продолжается в новом сообщении.
+    """
+
+    def __init__(self, update: Update, edit_interval=None):
+        self.update = update
+        self.edit_interval = stream_edit_interval if edit_interval is None else edit_interval
+        self.text = ""
+        self.messages = []  # отправленные сообщения
+        self.shown = []     # (текст, разметка), показанные в каждом из сообщений
+        self.next_edit_at = 0.0
+        self.started_at = time.monotonic()
+        self.first_text_at = None
+
+    async def start(self):
+        message = await self.update.message.reply_text(placeholder_text)
+        self.messages.append(message)
+        self.shown.append((placeholder_text, None))
+
+    async def push(self, delta: str):
+        if not delta:
+            return
+        if self.first_text_at is None:
+            self.first_text_at = time.monotonic()
+            logging.info(f"Первый фрагмент ответа через {self.first_text_at - self.started_at:.2f} сек.")
+        self.text += delta
+        if time.monotonic() >= self.next_edit_at:
+            try:
+                await self._render(self.text)
+            except RetryAfter as e:
+                # Превысили лимит Telegram - откладываем следующее обновление
+                self.next_edit_at = time.monotonic() + float(e.retry_after)
+                logging.warning(f"Telegram ограничил частоту редактирования, пауза {e.retry_after} сек.")
+
+    async def _render(self, text: str, markdown=None):
+        self.next_edit_at = time.monotonic() + self.edit_interval
+        for i, chunk in enumerate(split_text(text)):
+            if i < len(self.messages):
+                if self.shown[i] != (chunk, markdown):
+                    await self._edit(i, chunk, markdown)
+            else:
+                message = await self._send(chunk, markdown)
+                self.messages.append(message)
+                self.shown.append((chunk, markdown))
+
+    async def _edit(self, index, chunk, markdown):
+        try:
+            await self.messages[index].edit_text(chunk, parse_mode=markdown)
+        except BadRequest as e:
+            if is_not_modified(e):
+                pass
+            elif markdown is None:
+                raise
+            else:
+                # Не удалось разобрать разметку - показываем текст как есть
+                logging.warning(f"Ошибка разметки при редактировании сообщения: {e}")
+                try:
+                    await self.messages[index].edit_text(chunk)
+                except BadRequest as e2:
+                    if not is_not_modified(e2):
+                        raise
+        self.shown[index] = (chunk, markdown)
+
+    async def _send(self, chunk, markdown):
+        try:
+            return await self.update.message.reply_text(chunk, parse_mode=markdown)
+        except BadRequest as e:
+            if markdown is None:
+                raise
+            logging.warning(f"Ошибка разметки при отправке сообщения: {e}")
+            return await self.update.message.reply_text(chunk)
+
+    async def finish(self, final_text: str):
+        """Показывает итоговый текст с разметкой MarkdownV2."""
+        while True:
+            try:
+                await self._render(final_text, markdown=parse_mode)
+                break
+            except RetryAfter as e:
+                await asyncio.sleep(float(e.retry_after))
+        # Лишние сообщения остаются, если итоговый текст короче показанного
+        count = len(split_text(final_text))
+        for message in self.messages[count:]:
+            await message.delete()
+        del self.messages[count:]
+        del self.shown[count:]
+        logging.info(f"Ответ показан полностью через {time.monotonic() - self.started_at:.2f} сек.")
+
+    async def cancel(self):
+        """Удаляет заглушку, если ответ так и не был получен."""
+        for message in self.messages:
+            try:
+                await message.delete()
+            except BadRequest as e:
+                logging.warning(f"Не удалось удалить сообщение: {e}")
+        self.messages = []
+        self.shown = []
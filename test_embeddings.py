@@ -0,0 +1,94 @@
+import asyncio
+import math
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import embeddings
+from embeddings import EmbeddingCache, HashingEmbeddingProvider, get_cache_key, is_zero_vector
+
+
+class HashingEmbeddingProviderTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = HashingEmbeddingProvider(dimensions=64)
+
+    def test_vector_is_deterministic_and_normalized(self):
+        vector = self.provider.embed_one("Купить молоко завтра")
+        self.assertEqual(len(vector), 64)
+        self.assertEqual(vector, self.provider.embed_one("Купить молоко завтра"))
+        self.assertAlmostEqual(math.sqrt(sum(value * value for value in vector)), 1.0)
+
+    def test_case_and_yo_do_not_change_vector(self):
+        self.assertEqual(self.provider.embed_one("Ёлка"), self.provider.embed_one("елка"))
+
+    def test_text_without_words_gives_zero_vector(self):
+        for text in ("", "   ", "!?., —"):
+            vector = self.provider.embed_one(text)
+            self.assertEqual(len(vector), 64)
+            self.assertTrue(is_zero_vector(vector))
+
+    def test_embed_keeps_order(self):
+        texts = ["первая заметка", "вторая заметка"]
+        vectors = asyncio.run(self.provider.embed(texts))
+        self.assertEqual(vectors, [self.provider.embed_one(text) for text in texts])
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = EmbeddingCache(os.path.join(self.directory.name, "embeddings.sqlite"), max_entries=2)
+
+    def tearDown(self):
+        self.cache.connection.close()
+        self.directory.cleanup()
+
+    def test_hit_and_miss(self):
+        self.cache.put_many({"a": [0.5, -0.25]})
+        vectors = self.cache.get_many(["a", "b"])
+        self.assertEqual(vectors, {"a": [0.5, -0.25]})
+        self.assertEqual(self.cache.get_stats(), {"hits": 1, "misses": 1})
+
+    def test_evicts_least_recently_used(self):
+        with mock.patch.object(embeddings.time, "time", side_effect=[1.0, 2.0, 3.0, 4.0]):
+            self.cache.put_many({"a": [1.0]})
+            self.cache.put_many({"b": [2.0]})
+            # Обращение к "a" делает самой давно использованной запись "b"
+            self.cache.get_many(["a"])
+            self.cache.put_many({"c": [3.0]})
+        self.assertEqual(set(self.cache.get_many(["a", "b", "c"])), {"a", "c"})
+
+
+class GetEmbeddingsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.provider = HashingEmbeddingProvider(dimensions=16)
+        self.cache = EmbeddingCache(os.path.join(self.directory.name, "embeddings.sqlite"))
+        patcher = mock.patch.multiple(embeddings, embedding_provider=self.provider, embedding_cache=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.cache.connection.close()
+        self.directory.cleanup()
+
+    def test_second_call_is_served_from_cache(self):
+        texts = ["заметка", "заметка", "другая заметка"]
+        with mock.patch.object(self.provider, "embed", wraps=self.provider.embed) as embed:
+            first = asyncio.run(embeddings.get_embeddings(texts))
+            second = asyncio.run(embeddings.get_embeddings(texts))
+        # Одинаковые тексты запрашиваются у провайдера один раз, повторный вызов не обращается к нему
+        embed.assert_called_once_with(["заметка", "другая заметка"])
+        self.assertEqual(len(first), 3)
+        for cached, computed in zip(second, first):
+            self.assertEqual(len(cached), 16)
+            for a, b in zip(cached, computed):
+                self.assertAlmostEqual(a, b, places=6)
+
+    def test_cache_key_depends_on_provider_and_dimensions(self):
+        self.assertNotEqual(get_cache_key(self.provider, "текст"),
+                            get_cache_key(HashingEmbeddingProvider(dimensions=32), "текст"))
+
+
+if __name__ == '__main__':
+    unittest.main()
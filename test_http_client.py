@@ -0,0 +1,52 @@
+import asyncio
+import unittest
+from unittest import mock
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
+
+
+@unittest.skipUnless(aiohttp is not None, "aiohttp не установлен")
+class GetJsonTimeoutTest(unittest.TestCase):
+    async def start_server(self, delay):
+        async def handler(request):
+            await asyncio.sleep(delay)
+            return web.json_response({"ok": True})
+
+        app = web.Application()
+        app.router.add_get("/", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://127.0.0.1:{port}/"
+
+    async def get_json(self, delay, **kwargs):
+        import http_client
+        runner, url = await self.start_server(delay)
+        try:
+            return await http_client.get_json(url, retries=0, **kwargs)
+        finally:
+            await http_client.close_session()
+            await runner.cleanup()
+
+    def test_slow_endpoint_times_out_without_explicit_timeout(self):
+        import http_client
+        with mock.patch.object(http_client, "default_timeout", aiohttp.ClientTimeout(total=0.2)):
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(self.get_json(delay=1))
+
+    def test_slow_endpoint_times_out_with_explicit_timeout(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(self.get_json(delay=1, timeout=0.2))
+
+    def test_fast_endpoint_returns_json(self):
+        self.assertEqual(asyncio.run(self.get_json(delay=0)), {"ok": True})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from elastic import fuse_rankings, notes_rrf_k
+
+
+def notes(*note_ids):
+    return [{"NoteId": note_id, "Title": f"Заметка {note_id}"} for note_id in note_ids]
+
+
+class FuseRankingsTest(unittest.TestCase):
+    def test_notes_found_by_both_searches_come_first(self):
+        fused = fuse_rankings([notes("1", "2", "3"), notes("3", "4")], top_k=10)
+        # "2" и "4" на одной позиции в своих списках - при равной оценке порядок первого появления
+        self.assertEqual([note["NoteId"] for note in fused], ["3", "1", "2", "4"])
+
+    def test_score_is_sum_of_reciprocal_ranks(self):
+        fused = fuse_rankings([notes("1", "2"), notes("2")], top_k=10)
+        scores = {note["NoteId"]: note["Score"] for note in fused}
+        self.assertAlmostEqual(scores["2"], 1 / (notes_rrf_k + 2) + 1 / (notes_rrf_k + 1))
+        self.assertAlmostEqual(scores["1"], 1 / (notes_rrf_k + 1))
+
+    def test_result_is_cut_to_top_k(self):
+        fused = fuse_rankings([notes("1", "2", "3"), notes("4", "5")], top_k=2)
+        self.assertEqual(len(fused), 2)
+
+    def test_empty_rankings(self):
+        self.assertEqual(fuse_rankings([[], []], top_k=5), [])
+        self.assertEqual([note["NoteId"] for note in fuse_rankings([notes("1"), []], top_k=5)], ["1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
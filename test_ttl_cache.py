@@ -0,0 +1,75 @@
+import asyncio
+import time
+import unittest
+
+from ttl_cache import AsyncTTLCache
+
+
+class AsyncTTLCacheTest(unittest.TestCase):
+    def test_concurrent_requests_are_loaded_once(self):
+        cache = AsyncTTLCache("test")
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "value"
+
+        async def run():
+            expires_at = time.time() + 60
+            results = await asyncio.gather(*(cache.get_or_load("key", loader, expires_at) for _ in range(5)))
+            return results, await cache.get_or_load("key", loader, expires_at)
+
+        results, cached = asyncio.run(run())
+        self.assertEqual(results, ["value"] * 5)
+        self.assertEqual(cached, "value")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.get_stats(), {"entries": 1, "hits": 1, "misses": 1, "coalesced": 4})
+
+    def test_waiter_gets_value_when_leader_is_cancelled(self):
+        cache = AsyncTTLCache("test")
+        release = None
+
+        async def loader():
+            await release.wait()
+            return "value"
+
+        async def run():
+            nonlocal release
+            release = asyncio.Event()
+            expires_at = time.time() + 60
+            leader = asyncio.create_task(cache.get_or_load("key", loader, expires_at))
+            await asyncio.sleep(0)
+            waiter = asyncio.create_task(cache.get_or_load("key", loader, expires_at))
+            await asyncio.sleep(0)
+            leader.cancel()
+            await asyncio.sleep(0)
+            release.set()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            return await waiter
+
+        self.assertEqual(asyncio.run(run()), "value")
+        self.assertEqual(len(cache.data), 1)
+        self.assertEqual(cache.inflight, {})
+
+    def test_error_is_passed_to_waiters_and_not_cached(self):
+        cache = AsyncTTLCache("test")
+
+        async def loader():
+            await asyncio.sleep(0.01)
+            raise ValueError("нет данных")
+
+        async def run():
+            expires_at = time.time() + 60
+            return await asyncio.gather(*(cache.get_or_load("key", loader, expires_at) for _ in range(2)),
+                                        return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(cache.data, {})
+        self.assertEqual(cache.inflight, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
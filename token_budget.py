@@ -0,0 +1,99 @@
+import logging
+import os
+
+from state_and_commands import OpenAI_Models
+
+# Служебное поле сообщения с кэшированным количеством токенов. Поля с "_" не отправляются в API.
+TOKENS_FIELD = "_tokens"
+
+# Накладные токены на каждое сообщение в формате chat completions
+MESSAGE_OVERHEAD_TOKENS = 3
+# Стоимость изображения в режиме detail=high после уменьшения до 768 по короткой стороне
+IMAGE_TOKENS = 765
+
+# Ограничение размера запроса (системное сообщение + история) в токенах по моделям
+prompt_token_limits = {
+    OpenAI_Models.DEFAULT_MODEL.value: int(os.getenv('PROMPT_TOKEN_LIMIT', '16000')),
+    OpenAI_Models.O1_MINI.value: int(os.getenv('PROMPT_TOKEN_LIMIT_MINI', '16000')),
+}
+
+encoding = None
+encoding_failed = False
+
+
+def get_encoding():
+    """Загружает токенизатор при первом использовании."""
+    global encoding, encoding_failed
+    if encoding is None and not encoding_failed:
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # Без токенизатора используем приблизительную оценку
+            encoding_failed = True
+            logging.error(f"Не удалось загрузить токенизатор, используется оценка по длине текста: {e}")
+    return encoding
+
+
+def count_text_tokens(text: str) -> int:
+    enc = get_encoding()
+    if enc is None:
+        return len(text) // 3 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message: dict) -> int:
+    """Количество токенов сообщения. Считается один раз и сохраняется в самом сообщении."""
+    tokens = message.get(TOKENS_FIELD)
+    if tokens is not None:
+        return tokens
+    content = message.get("content") or ""
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    if isinstance(content, str):
+        tokens += count_text_tokens(content)
+    else:
+        for part in content:
+            if part.get("type") == "text":
+                tokens += count_text_tokens(part["text"])
+            elif part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS
+    message[TOKENS_FIELD] = tokens
+    return tokens
+
+
+def get_prompt_token_limit(model_name: str) -> int:
+    return prompt_token_limits.get(model_name, prompt_token_limits[OpenAI_Models.DEFAULT_MODEL.value])
+
+
+def trim_history(history: list[dict], max_tokens: int) -> list[dict]:
+    """Урезает историю до max_tokens токенов.
+
+    Сначала удаляются самые старые системные сообщения (результаты инструментов, заметки,
+    прогнозы погоды), затем самые старые реплики беседы. Последнее сообщение не удаляется никогда.
+    """
+    total = sum(count_message_tokens(message) for message in history)
+    if total <= max_tokens:
+        return history
+
+    removed = set()
+    for roles in (("system", "tool"), None):
+        for i, message in enumerate(history[:-1]):
+            if total <= max_tokens:
+                break
+            if i in removed or (roles is not None and message["role"] not in roles):
+                continue
+            removed.add(i)
+            total -= count_message_tokens(message)
+
+    trimmed = [message for i, message in enumerate(history) if i not in removed]
+    # История не должна начинаться с ответа ассистента без вопроса
+    while len(trimmed) > 1 and trimmed[0]["role"] == "assistant":
+        trimmed.pop(0)
+    logging.info(f"История урезана до {sum(count_message_tokens(m) for m in trimmed)} токенов: "
+                 f"удалено сообщений {len(history) - len(trimmed)}")
+    return trimmed
+
+
+def prepare_messages(messages: list[dict]) -> list[dict]:
+    """Убирает служебные поля перед отправкой сообщений в API."""
+    return [{key: value for key, value in message.items() if not key.startswith("_")} for message in messages]
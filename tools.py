@@ -0,0 +1,74 @@
+import json
+import logging
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+
+class ToolContext:
+    """Данные запроса, доступные обработчикам инструментов."""
+
+    def __init__(self, openai_client, update: Update, context: ContextTypes.DEFAULT_TYPE, model_name: str):
+        self.openai_client = openai_client
+        self.update = update
+        self.context = context
+        self.model_name = model_name
+
+    @property
+    def user_id(self):
+        return self.update.effective_user.id
+
+
+class ToolResult:
+    """Результат вызова инструмента.
+
+    content - текст, который возвращается модели; при remember=True он также сохраняется
+    в истории как системное сообщение. reply - готовый ответ пользователю, после которого
+    цикл вызова инструментов завершается. stop - завершить цикл без ответа.
+    """
+
+    def __init__(self, content: str = None, reply: str = None, stop: bool = False, remember: bool = True):
+        self.content = content
+        self.reply = reply
+        self.stop = stop
+        self.remember = remember
+
+    @property
+    def is_final(self) -> bool:
+        return self.stop or self.reply is not None
+
+
+class Tool:
+    def __init__(self, schema: dict, handler):
+        self.name = schema["name"]
+        self.schema = schema
+        # async handler(ctx: ToolContext, args: dict) -> ToolResult
+        self.handler = handler
+
+
+tool_registry: dict[str, Tool] = {}
+
+
+def register_tool(schema: dict, handler):
+    tool_registry[schema["name"]] = Tool(schema, handler)
+
+
+def get_tool_schemas() -> list[dict]:
+    """Схемы инструментов в формате tools API. Порядок стабилен, чтобы не ломать кэш промпта."""
+    return [{"type": "function", "function": tool.schema} for tool in tool_registry.values()]
+
+
+async def execute_tool_call(tool_call, ctx: ToolContext) -> ToolResult:
+    name = tool_call.function.name
+    tool = tool_registry.get(name)
+    if tool is None:
+        logging.error(f"Модель вызвала неизвестный инструмент {name}")
+        return ToolResult(content=f"Инструмент {name} не существует.", remember=False)
+    try:
+        arguments = tool_call.function.arguments
+        args = json.loads(arguments) if arguments else {}
+        logging.info(f"Вызываем инструмент {name}. Аргументы: {args}")
+        return await tool.handler(ctx, args)
+    except Exception as e:
+        logging.error(f"Ошибка при вызове инструмента {name}: {e}", exc_info=True)
+        return ToolResult(content=f"Ошибка при вызове инструмента {name}: {e}", remember=False)
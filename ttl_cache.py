@@ -0,0 +1,72 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+def get_aligned_expiry(period: float, offset: float = 0.0) -> float:
+    """Время (unix) следующей границы периода - для кэша данных, обновляемых по расписанию."""
+    now = time.time()
+    return (int((now - offset) // period) + 1) * period + offset
+
+
+class AsyncTTLCache:
+    """Кэш результатов асинхронных запросов с временем жизни записей.
+
+    Одновременные запросы одного и того же ключа объединяются: загрузка выполняется
+    один раз, остальные ожидают ее результат.
+    """
+
+    def __init__(self, name, max_entries=1024):
+        self.name = name
+        self.max_entries = max_entries
+        self.data = OrderedDict()  # ключ -> (время истечения unix, значение)
+        self.inflight = {}         # ключ -> Future выполняющейся загрузки
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_or_load(self, key, loader, expires_at: float):
+        """Возвращает значение из кэша или загружает его через loader() до момента expires_at."""
+        item = self.data.get(key)
+        if item is not None:
+            if item[0] > time.time():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            del self.data[key]
+
+        task = self.inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        self.misses += 1
+        # Загрузка выполняется в отдельной задаче: отмена запроса, начавшего загрузку,
+        # не прерывает ее для остальных ожидающих
+        task = asyncio.ensure_future(self._load(key, loader, expires_at))
+        self.inflight[key] = task
+        task.add_done_callback(lambda done: self._finish_load(key, done))
+        return await asyncio.shield(task)
+
+    async def _load(self, key, loader, expires_at):
+        value = await loader()
+        self.data[key] = (expires_at, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_entries:
+            self.data.popitem(last=False)
+        return value
+
+    def _finish_load(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        # Ошибка уже передана ожидающим, а если их не осталось - не должна попасть в лог как необработанная
+        if not task.cancelled():
+            task.exception()
+
+    def get_stats(self) -> dict:
+        return {
+            "entries": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
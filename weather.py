@@ -1,9 +1,9 @@
 
 from datetime import datetime, timedelta
 import os
-import requests
 
-from common_types import dict_to_markdown
+from http_client import HTTP_ERRORS, get_json
+from ttl_cache import AsyncTTLCache, get_aligned_expiry
 
 
 weather_api_key=os.getenv('OPENWEATHERMAP_API_KEY')
@@ -46,88 +46,141 @@ def get_weather_description_by_code(code):
 
 
 
-def get_weekly_forecast(latitude, longitude):
+# Шаг сетки для округления координат: точки внутри одной ячейки модели получают один прогноз
+weather_grid_step = float(os.getenv('WEATHER_GRID_STEP', '0.05'))
+# Периоды обновления данных open-meteo: текущая погода - ежечасно, прогноз на неделю - раз в несколько часов
+current_weather_update_period = 3600
+weekly_forecast_update_period = 3 * 3600
+
+weather_cache = AsyncTTLCache("weather", max_entries=int(os.getenv('WEATHER_CACHE_SIZE', '1024')))
+
+
+def quantize_coordinates(latitude, longitude):
+    """Округляет координаты до узла сетки weather_grid_step."""
+    digits = max(0, len(str(weather_grid_step).split(".")[-1]))
+    return (round(round(float(latitude) / weather_grid_step) * weather_grid_step, digits),
+            round(round(float(longitude) / weather_grid_step) * weather_grid_step, digits))
+
+
+# Поля прогноза на неделю, которые попадают в ответ модели
+weekly_forecast_fields = [
+    "weather_code",
+    "temperature_2m_min",
+    "temperature_2m_max",
+    "precipitation_sum",
+    "wind_speed_10m_max",
+    "relative_humidity_2m_min",
+    "relative_humidity_2m_max",
+]
+
+
+def format_value(value):
+    if value is None:
+        return "?"
+    return f"{value:g}" if isinstance(value, float) else str(value)
+
+
+def encode_weekly_forecast(forecast_data) -> str:
+    """Кодирует прогноз на неделю компактной таблицей: одна строка на день."""
+    daily = forecast_data.get("daily", {})
+    lines = [
+        f"Прогноз погоды на неделю ({forecast_data.get('timezone', 'местное время')}).",
+        "дата|t мин..макс °C|осадки мм|ветер макс км/ч|влажность %|погода",
+    ]
+    for i, date in enumerate(daily.get("time", [])):
+        row = {field: (daily.get(field) or [None] * (i + 1))[i] for field in weekly_forecast_fields}
+        lines.append(
+            f"{date}|{format_value(row['temperature_2m_min'])}..{format_value(row['temperature_2m_max'])}"
+            f"|{format_value(row['precipitation_sum'])}|{format_value(row['wind_speed_10m_max'])}"
+            f"|{format_value(row['relative_humidity_2m_min'])}-{format_value(row['relative_humidity_2m_max'])}"
+            f"|{get_weather_description_by_code(row['weather_code'])}")
+    return "\n".join(lines)
+
+
+async def fetch_weekly_forecast(latitude, longitude):
     url = "https://api.open-meteo.com/v1/forecast"
     params = {
         "latitude": latitude,  # Широта
         "longitude": longitude,  # Долгота
-        "daily": "temperature_2m_max,temperature_2m_min,precipitation_sum,windspeed_10m_max,relative_humidity_2m_max,relative_humidity_2m_min",  # Данные для прогноза
+        "daily": ",".join(weekly_forecast_fields),  # Только используемые данные прогноза
         "timezone": "auto",  # Временная зона
     }
+    return encode_weekly_forecast(await get_json(url, params=params))
 
+
+async def get_weekly_forecast(latitude, longitude):
+    latitude, longitude = quantize_coordinates(latitude, longitude)
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()  # Проверка на ошибки HTTP
-        forecast_data = response.json()
-        return dict_to_markdown(forecast_data)
-    except requests.exceptions.RequestException as e:
+        return await weather_cache.get_or_load(
+            ("weekly", latitude, longitude),
+            lambda: fetch_weekly_forecast(latitude, longitude),
+            get_aligned_expiry(weekly_forecast_update_period))
+    except HTTP_ERRORS as e:
         return(f"Ошибка при запросе погоды: {e}")
 
 
+def round_time_to_hour(time_str):
+    """Округляет время до ближайшего часа."""
+    time = datetime.fromisoformat(time_str)
+    rounded_time = time.replace(minute=0, second=0, microsecond=0)
+    if time.minute >= 30:  # Если больше 30 минут, округляем вверх
+        rounded_time += timedelta(hours=1)
+    return rounded_time
+
+
+def get_hour_index(first_time_str, time_str) -> int:
+    """Индекс часа time_str в почасовом ряду, начинающемся с first_time_str."""
+    first_time = datetime.fromisoformat(first_time_str)
+    return int((round_time_to_hour(time_str) - first_time).total_seconds() // 3600)
+
 
-def get_weather_by_coordinates2(latitude, longitude):
+async def fetch_weather_by_coordinates2(latitude, longitude):
     url = "https://api.open-meteo.com/v1/forecast"
     params = {
         "latitude": latitude,  # Широта
         "longitude": longitude,  # Долгота
-        "current_weather": True,  # Запрос текущей погоды
+        "current_weather": "true",  # Запрос текущей погоды
         "hourly": "relative_humidity_2m",  # Добавляем влажность
+        "forecast_days": 2,  # Округленный вверх текущий час может прийтись на следующие сутки
     }
+    weather_data = await get_json(url, params=params)
+    current = weather_data.get("current_weather", {})
+
+    # Влажность за текущий час находим по смещению от начала почасового ряда
+    hourly_data = weather_data.get("hourly", {})
+    humidity_values = hourly_data.get("relative_humidity_2m", [])
+    times = hourly_data.get("time", [])
+    current_humidity = None
+    if current.get("time") and times:
+        humidity_index = get_hour_index(times[0], current["time"])
+        if 0 <= humidity_index < len(humidity_values):
+            current_humidity = humidity_values[humidity_index]
+
+    return {
+        "weathercode": current.get("weathercode"),
+        "temperature": current.get("temperature"),
+        "windspeed": current.get("windspeed"),
+        "humidity": current_humidity,
+    }
+
+
+async def get_weather_by_coordinates2(latitude, longitude):
+    latitude, longitude = quantize_coordinates(latitude, longitude)
+    return await weather_cache.get_or_load(
+        ("current", latitude, longitude),
+        lambda: fetch_weather_by_coordinates2(latitude, longitude),
+        get_aligned_expiry(current_weather_update_period))
+
 
+async def get_weather_description2(latitude, longitude):
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()  # Проверка на ошибки HTTP
-        weather_data = response.json()
-        return weather_data
-    except requests.exceptions.RequestException as e:
+        weather = await get_weather_by_coordinates2(latitude, longitude)
+    except HTTP_ERRORS as e:
         return(f"Ошибка при запросе погоды: {e}")
 
-
-def round_time_to_hour(time_str):
-    """Округляет время до ближайшего часа."""
-    time = datetime.fromisoformat(time_str)
-    rounded_time = time.replace(minute=0, second=0, microsecond=0)
-    if time.minute >= 30:  # Если больше 30 минут, округляем вверх
-        rounded_time += timedelta(hours=1)
-    return rounded_time.isoformat()
-
-def get_weather_description2(latitude, longitude):
-    weather_data = get_weather_by_coordinates2(latitude, longitude)
-    # Вывод результата
-    if "error" in weather_data:
-        result=f"Ошибка: {weather_data['error']}"
-    else:
-        current = weather_data.get("current_weather", {})
-
-        # Получаем влажность из hourly данных
-        hourly_data = weather_data.get("hourly", {})
-        humidity_values = hourly_data.get("relative_humidity_2m", [])
-        times = hourly_data.get("time", [])
-
-        # Найти текущую влажность, соответствующую времени current_weather
-        current_time = current.get("time")
-        current_time=round_time_to_hour(current_time)
-        if current_time.endswith(':00'):
-            current_time = current_time[:-3]
-        if current_time and times and humidity_values:
-            try:
-                humidity_index = times.index(current_time)
-                current_humidity = humidity_values[humidity_index]
-            except ValueError:
-                current_humidity = "неизвестно"
-        else:
-            current_humidity = "неизвестно"
-
-
-        weather_code = current["weathercode"]
-        description = get_weather_description_by_code(weather_code)
-        t= current.get("temperature", "нет данных")
-        
-        #pressure = current.get("pressure", "нет данных")
-        #humidity = current.get("humidity", "нет данных")
-        wind_speed  = current.get("windspeed", "нет данных")
-
-        result = f"Погода: {description}, температура: {t}°C, скорость ветра {wind_speed} км/ч, влажность {current_humidity}."
+    description = get_weather_description_by_code(weather["weathercode"])
+    t = format_value(weather["temperature"]) if weather["temperature"] is not None else "нет данных"
+    wind_speed = format_value(weather["windspeed"]) if weather["windspeed"] is not None else "нет данных"
+    humidity = f"{format_value(weather['humidity'])}%" if weather["humidity"] is not None else "неизвестно"
     # Возврат сообщения с описанием погоды
-    return result
-
+    return f"Погода: {description}, температура: {t}°C, скорость ветра {wind_speed} км/ч, влажность {humidity}."
@@ -1,33 +1,67 @@
 import logging
 import os
-import requests
-from ymaps import Geocode, GeocodeAsync
+
+from geocode_cache import create_geocode_cache_from_os
+from http_client import HTTP_ERRORS, get_json
 
 # Ваш API-ключ
 API_KEY = os.getenv('YMAPS_GEOCODER')
 
+# Клиент геокодера и кэш создаются при первом обращении и используются повторно
+geocoder = None
+geocode_cache = None
+
+
+def get_geocoder():
+    global geocoder
+    if geocoder is None:
+        from ymaps import GeocodeAsync
+        geocoder = GeocodeAsync(API_KEY)
+    return geocoder
+
+
+def get_geocode_cache():
+    global geocode_cache
+    if geocode_cache is None:
+        geocode_cache = create_geocode_cache_from_os()
+    return geocode_cache
+
 
 async def get_address(latitude, longitude):
+    address = get_geocode_cache().get_address(latitude, longitude)
+    if address is not None:
+        logging.info(f'Адрес из кэша: {address}')
+        return address
     try:
-        # Создаем асинхронный клиент для геокодирования
-        geocoder = GeocodeAsync(API_KEY)
-    
         # Выполняем обратное геокодирование
-        response = await geocoder.reverse([longitude, latitude])
+        response = await get_geocoder().reverse([longitude, latitude])
 
         # Проверяем успешность запроса
         if response and 'response' in response:
             geo_object = response['response']['GeoObjectCollection']['featureMember'][0]['GeoObject']
             address = geo_object['metaDataProperty']['GeocoderMetaData']['text']
             logging.info(f'Адрес: {address}')
+            get_geocode_cache().put_address(latitude, longitude, address)
             return address
         else:
             logging.error('Не удалось получить адрес по заданным координатам.')
     except Exception as e:
         logging.exception(f"Ошибка при получениии адреса: {e}")
     return None
-    
-def get_location_by_address(address):
+
+
+async def get_location_by_address(address):
+    location = get_geocode_cache().get_location(address)
+    if location is not None:
+        logging.info(f'Геолокация из кэша: {address} -> {location}')
+        return location
+    location = await fetch_location_by_address(address)
+    if location is not None:
+        get_geocode_cache().put_location(address, *location)
+    return location
+
+
+async def fetch_location_by_address(address):
     try:
         # Запрос
         url = f"https://geocode-maps.yandex.ru/1.x/"
@@ -36,19 +70,17 @@ def get_location_by_address(address):
             "geocode": address,
             "format": "json"
         }
-        response = requests.get(url, params=params)
+        data = await get_json(url, params=params)
 
         # Обработка ответа
-        if response.status_code == 200:
-            data = response.json()
-            try:
-                pos = data["response"]["GeoObjectCollection"]["featureMember"][0]["GeoObject"]["Point"]["pos"]
-                longitude, latitude = map(float, pos.split())
-                return (latitude, longitude)
-            except (IndexError, KeyError):
-                return None
-        else:
-            logging.exception(f"Ошибка: {response.status_code}")
+        try:
+            pos = data["response"]["GeoObjectCollection"]["featureMember"][0]["GeoObject"]["Point"]["pos"]
+            longitude, latitude = map(float, pos.split())
+            return (latitude, longitude)
+        except (IndexError, KeyError):
+            return None
+    except HTTP_ERRORS as e:
+        logging.error(f"Ошибка при запросе геолокации по адресу: {e!r}")
     except Exception as e:
         logging.exception(f"Ошибка при получениии геолокации по адресу: {e}")
     return None